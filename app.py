@@ -1,16 +1,42 @@
 import os
+import time
+import bisect
+from contextvars import ContextVar
+from collections import OrderedDict, deque
+import heapq
+import threading
+import atexit
+import socket
+from functools import wraps
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request, abort, render_template
-from pymongo import MongoClient
+from flask import Flask, jsonify, request, abort, render_template, Response, g
+from flask.json.provider import DefaultJSONProvider
+import click
+from pymongo import MongoClient, IndexModel, ASCENDING, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 from datetime import datetime, timedelta
 from bson.objectid import ObjectId
 from bson.objectid import InvalidId
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.base import JobLookupError
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
 load_dotenv()
 
+# Fast JSON libraries are used when installed -- orjson first, then msgspec for encoding
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
 
 # This is the object model to be uploaded to the MongoDb database
 class Quiz:
@@ -22,46 +48,2116 @@ class Quiz:
         self.start_date = start_date
         self.end_date = end_date
         self.status = False
+        # Options joined with "," -- a scalar copy of options that an index can cover
+        # (options never contain "," as they are split on it)
+        self.options_text = ",".join(options)
+
+
+# Types the stdlib json does not know -- ObjectId as its hex string, datetime in ISO format
+def json_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
+
+
+msgspec_encoder = msgspec.json.Encoder(enc_hook=json_default) if msgspec else None
+
+
+# JSON encoding of the app -- the fast library when available, the stdlib json otherwise
+# Keys are not sorted on the fast path, the stdlib path keeps the Flask defaults
+class FastJSONMixin:
+    default = staticmethod(json_default)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None:
+            option = orjson.OPT_INDENT_2 if kwargs.get("indent") else 0
+            return orjson.dumps(obj, default=json_default, option=option).decode()
+
+        if msgspec_encoder is not None and not kwargs.get("indent"):
+            return msgspec_encoder.encode(obj).decode()
+
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None:
+            return orjson.loads(s)
+
+        return super().loads(s, **kwargs)
+
+
+class QuizJSONProvider(FastJSONMixin, DefaultJSONProvider):
+    pass
+
+
+# Flask app is created
+app = Flask(__name__)
+app.json_provider_class = QuizJSONProvider
+app.json = QuizJSONProvider(app)
+
+# Storage of the rate limit counters -- memory:// keeps them per worker and loses them on restart
+# A mongodb:// or redis:// URL shares them between all the workers
+RATELIMIT_STORAGE_URI = os.environ.get("RATELIMIT_STORAGE_URI", "memory://")
+
+# Limiter to limit the requests from a single IP address
+# The moving window is updated atomically by the storage (a single command per hit)
+# If the shared storage is down, the limits are kept in memory until it is back
+limiter = Limiter(
+    get_remote_address,
+    app=app,
+    default_limits=["1000 per day"],
+    storage_uri=RATELIMIT_STORAGE_URI,
+    strategy="moving-window",
+    in_memory_fallback_enabled=True,
+)
+
+# MongoDb configuration -- pool size, timeouts and wire compression can be set from the environment
+# Compressors whose library is not installed are skipped by the driver (snappy needs python-snappy)
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": int(os.environ.get("MONGODB_MAX_POOL_SIZE", "100")),
+    "minPoolSize": int(os.environ.get("MONGODB_MIN_POOL_SIZE", "0")),
+    "serverSelectionTimeoutMS": int(os.environ.get("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+    "connectTimeoutMS": int(os.environ.get("MONGODB_CONNECT_TIMEOUT_MS", "5000")),
+    "socketTimeoutMS": int(os.environ.get("MONGODB_SOCKET_TIMEOUT_MS", "10000")),
+    "compressors": os.environ.get("MONGODB_COMPRESSORS", "zstd,zlib"),
+}
+
+
+# Latency histogram -- cumulative counts per upper bound, in seconds
+class Histogram:
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        buckets = {}
+        total = 0
+        for bound, count in zip(self.BUCKETS + ("+Inf",), self.counts):
+            total += count
+            buckets[str(bound)] = total
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+# Counter that takes no lock on the hot path -- each thread adds to its own dict,
+# the dicts of all the threads are added up when the totals are read. The dict of a thread
+# that has ended is folded into retired, so threads coming and going do not pile up dicts
+class ThreadLocalCounter:
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.retired = {}
+        self.shards_lock = threading.Lock()
+
+    def add(self, key, value=1):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.shards_lock:
+                self.retire_ended_threads()
+                self.shards.append((threading.current_thread(), shard))
+        shard[key] = shard.get(key, 0) + value
+
+    # Called with shards_lock held
+    def retire_ended_threads(self):
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+                continue
+            for key, value in shard.items():
+                self.retired[key] = self.retired.get(key, 0) + value
+        self.shards = live
+
+    def totals(self):
+        with self.shards_lock:
+            self.retire_ended_threads()
+            shards = [shard for _, shard in self.shards]
+            totals = dict(self.retired)
+
+        for shard in shards:
+            for key, value in list(shard.items()):
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+
+# Counters of the metrics that have no other home -- by (metric name, labels)
+metric_counters = ThreadLocalCounter()
+
+
+# Connection pool statistics of this process -- updated by the driver events
+class PoolStats(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            "connections_created": 0,
+            "connections_closed": 0,
+            "connections_in_use": 0,
+            "checkouts": 0,
+            "checkout_failures": 0,
+            "pools_cleared": 0,
+        }
+        self.checkout_wait_seconds = 0.0
+        self.checkout_wait = Histogram()
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["checkout_wait_seconds"] = self.checkout_wait_seconds
+            stats["checkout_wait"] = self.checkout_wait.snapshot()
+        stats["pid"] = os.getpid()
+        stats.update(MONGO_CLIENT_OPTIONS)
+        return stats
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.add("pools_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.add("connections_created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.add("connections_closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.add("checkout_failures")
+
+    def connection_checked_out(self, event):
+        with self.lock:
+            self.counters["checkouts"] += 1
+            self.counters["connections_in_use"] += 1
+            # Time spent waiting for a connection -- reported by the driver since pymongo 4.7
+            wait = getattr(event, "duration", 0) or 0
+            self.checkout_wait_seconds += wait
+            self.checkout_wait.observe(wait)
+
+    def connection_checked_in(self, event):
+        self.add("connections_in_use", -1)
+
+
+pool_stats = PoolStats()
+
+# MongoDb usage of the request being handled -- None outside of a request
+request_mongo_stats = ContextVar("request_mongo_stats", default=None)
+
+
+# Adds the time and the documents of each MongoDb command to the request that sent it
+class MongoCommandTimer(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        stats = request_mongo_stats.get()
+        if stats is None:
+            return
+
+        stats["mongo_seconds"] += event.duration_micros / 1e6
+        stats["commands"] += 1
+
+        # find and getMore return a batch of documents, findAndModify a single one
+        cursor = event.reply.get("cursor")
+        if cursor is not None:
+            batch = cursor.get("firstBatch", cursor.get("nextBatch"))
+            stats["documents"] += len(batch or [])
+        elif event.reply.get("value") is not None:
+            stats["documents"] += 1
+
+    def failed(self, event):
+        stats = request_mongo_stats.get()
+        if stats is None:
+            return
+
+        stats["mongo_seconds"] += event.duration_micros / 1e6
+        stats["commands"] += 1
+
+
+command_timer = MongoCommandTimer()
+
+mongo_client = None
+mongo_client_pid = None
+mongo_client_lock = threading.Lock()
+
+
+# MongoClient of this process -- created on first use, and again in a forked worker
+# as a client must not be shared across fork
+def get_mongo_client():
+    global mongo_client, mongo_client_pid
+
+    if mongo_client is None or mongo_client_pid != os.getpid():
+        with mongo_client_lock:
+            if mongo_client is None or mongo_client_pid != os.getpid():
+                mongo_client = MongoClient(
+                    os.environ.get("MONGODB_CONNECTION_URL"),
+                    event_listeners=[pool_stats, command_timer],
+                    **MONGO_CLIENT_OPTIONS,
+                )
+                mongo_client_pid = os.getpid()
+
+    return mongo_client
+
+
+# Collection of the database that is resolved on use -- no connection is made at import
+class LazyCollection:
+    def __init__(self, database_name, collection_name, codec_options=None):
+        self.database_name = database_name
+        self.collection_name = collection_name
+        self.codec_options = codec_options
+
+    def __getattr__(self, name):
+        collection = get_mongo_client()[self.database_name][self.collection_name]
+        if self.codec_options is not None:
+            collection = collection.with_options(codec_options=self.codec_options)
+        return getattr(collection, name)
+
+
+# Documents are kept as raw BSON and only decoded when a field is read
+RAW_DOCUMENT_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+quizzes_collection = LazyCollection("timed_quiz", "quizzes")
+
+# Small documents shared by the workers -- the quizzes version
+meta_collection = LazyCollection("timed_quiz", "meta")
+
+# Same collection for the quiz listings -- their covered reads are returned as raw BSON
+quiz_summaries_collection = LazyCollection(
+    "timed_quiz", "quizzes", codec_options=RAW_DOCUMENT_OPTIONS
+)
+
+# Answers submitted by the participants -- quiz_id, participant, answer, submitted_at
+answers_collection = LazyCollection("timed_quiz", "answers")
+
+# Answers counted by option -- {_id: quiz id, counts: {"<option index>": n}, total: n}
+tallies_collection = LazyCollection("timed_quiz", "tallies")
+
+# Indexes used by the quiz queries -- status updater and boundaries
+# The active quizzes are served from the quiz schedule, so no index covers their range
+QUIZ_INDEXES = [
+    IndexModel([("start_date", ASCENDING)], name="start_date_1"),
+    IndexModel([("end_date", ASCENDING)], name="end_date_1"),
+    IndexModel([("status", ASCENDING)], name="status_1"),
+    # Covering index of GET /quizzes/all -- every projected field is in the index,
+    # options_text stands in for options as an array field cannot be covered
+    IndexModel(
+        [("_id", ASCENDING), ("question", ASCENDING), ("options_text", ASCENDING)],
+        name="all_quizzes_covered",
+    ),
+]
+
+# Indexes of earlier versions no query uses any more -- dropped by the indexes command
+UNUSED_QUIZ_INDEXES = ["start_date_1_end_date_1", "active_quizzes_covered"]
+
+
+# One answer per participant and quiz -- the first one is kept
+ANSWER_INDEXES = [
+    IndexModel(
+        [("quiz_id", ASCENDING), ("participant", ASCENDING)],
+        name="quiz_id_1_participant_1",
+        unique=True,
+    ),
+]
+
+# Every collection with the indexes it needs
+COLLECTION_INDEXES = [
+    (quizzes_collection, QUIZ_INDEXES),
+    (answers_collection, ANSWER_INDEXES),
+]
+
+
+# Creates the indexes -- safe to run again, existing indexes are left as they are
+def create_indexes():
+    for collection, indexes in COLLECTION_INDEXES:
+        collection.create_indexes(indexes)
+
+
+# Keys (in order) and uniqueness of an index, as declared or as listed by the database
+def index_spec(document):
+    return list(document["key"].items()), bool(document.get("unique", False))
+
+
+# Indexes that are not in the database as declared -- (collection, name, stale), stale when
+# an index of that name exists with other keys or uniqueness and must be dropped first
+def missing_indexes():
+    missing = []
+    for collection, indexes in COLLECTION_INDEXES:
+        existing = {index["name"]: index_spec(index) for index in collection.list_indexes()}
+        for index in indexes:
+            name = index.document["name"]
+            if existing.get(name) != index_spec(index.document):
+                missing.append((collection, name, name in existing))
+    return missing
+
+
+# Sets options_text on the quizzes stored before it existed
+def backfill_options_text():
+    return quizzes_collection.update_many(
+        {"options_text": {"$exists": False}},
+        [
+            {
+                "$set": {
+                    "options_text": {
+                        "$reduce": {
+                            "input": "$options",
+                            "initialValue": None,
+                            "in": {
+                                "$cond": [
+                                    {"$eq": ["$$value", None]},
+                                    "$$this",
+                                    {"$concat": ["$$value", ",", "$$this"]},
+                                ]
+                            },
+                        }
+                    }
+                }
+            }
+        ],
+    )
+
+
+# Indexes are created when the app starts -- the app still runs if MongoDb is unreachable
+try:
+    create_indexes()
+    backfill_options_text()
+except PyMongoError as error:
+    app.logger.warning("Could not create the quiz indexes: %s", error)
+
+# Page size of GET /quizzes/all -- the max is enforced whatever the client asks for
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# POST /quizzes/bulk -- quizzes accepted per request and written per insert_many
+MAX_BULK_QUIZZES = 10000
+BULK_CHUNK_SIZE = 1000
+
+# Upper bound on the life of the cached active quizzes, in seconds
+# Other workers do not see a create_quiz invalidation, this bounds how stale they can get
+ACTIVE_QUIZ_CACHE_MAX_AGE = float(os.environ.get("ACTIVE_QUIZ_CACHE_MAX_AGE", "5"))
+
+# Seconds a worker trusts its copy of the quizzes version before reading it again
+# Bounds how long the ETags of a worker can miss a change made by another worker
+QUIZZES_VERSION_MAX_AGE = float(os.environ.get("QUIZZES_VERSION_MAX_AGE", "5"))
+
+# Released results kept in memory, and how long clients and CDNs may keep them (one year)
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "10000"))
+RESULT_MAX_AGE = 365 * 24 * 60 * 60
+
+# POST /quizzes/results -- quiz ids accepted per request
+MAX_BATCH_RESULTS = 1000
+
+# Unknown and not yet released quiz ids kept in memory, and how long an unknown id is kept
+NEGATIVE_RESULT_CACHE_SIZE = int(os.environ.get("NEGATIVE_RESULT_CACHE_SIZE", "10000"))
+MISSING_RESULT_TTL = float(os.environ.get("MISSING_RESULT_TTL", "30"))
+
+# POST /quizzes/<id>/answers -- answers are written in batches, ANSWER_FLUSH_MS after the first
+# one waiting or as soon as ANSWER_BATCH_SIZE are waiting. New answers are refused (503)
+# while MAX_PENDING_ANSWERS are waiting, e.g. when MongoDb is down
+ANSWER_FLUSH_MS = int(os.environ.get("ANSWER_FLUSH_MS", "100"))
+ANSWER_BATCH_SIZE = int(os.environ.get("ANSWER_BATCH_SIZE", "1000"))
+MAX_PENDING_ANSWERS = int(os.environ.get("MAX_PENDING_ANSWERS", "100000"))
+
+# Seconds between two writes of the answer tallies to MongoDb -- GET /quizzes/<id>/tally
+# keeps what it read for as long
+TALLY_FLUSH_SECONDS = float(os.environ.get("TALLY_FLUSH_SECONDS", "1"))
+TALLY_CACHE_SIZE = int(os.environ.get("TALLY_CACHE_SIZE", "10000"))
+
+# Live tallies (ASGI app) -- milliseconds between two updates, and updates a viewer can fall
+# behind by before it is disconnected
+TALLY_LIVE_TICK_MS = int(os.environ.get("TALLY_LIVE_TICK_MS", "250"))
+TALLY_LIVE_BUFFER = int(os.environ.get("TALLY_LIVE_BUFFER", "64"))
+
+# Minutes between two full syncs of the quiz boundaries
+# Picks up quizzes created by other workers, boundaries themselves run as one-shot jobs
+STATUS_SYNC_MINUTES = int(os.environ.get("STATUS_SYNC_MINUTES", "5"))
+
+# Number of upcoming start_date and end_date values loaded in memory at once
+BOUNDARY_BATCH_SIZE = 1000
+
+# Scheduler lease -- seconds another process waits before taking over a leader that stopped
+# renewing, and seconds between two renewals
+LEADER_LEASE_SECONDS = int(os.environ.get("LEADER_LEASE_SECONDS", "30"))
+LEADER_RENEW_SECONDS = int(os.environ.get("LEADER_RENEW_SECONDS", "10"))
+
+# Background task that updates the Status of the Quiz -- Active or Not
+scheduler = BackgroundScheduler()
+scheduler.start()
+
+# Durations of the scheduled jobs of this worker, by job
+job_timings = {}
+job_timings_lock = threading.Lock()
+
+
+def record_job_timing(job, seconds):
+    with job_timings_lock:
+        if job not in job_timings:
+            job_timings[job] = Histogram()
+        job_timings[job].observe(seconds)
+
+
+def job_timings_snapshot():
+    with job_timings_lock:
+        return {job: histogram.snapshot() for job, histogram in job_timings.items()}
+
+
+# Records the duration of every run of a job, failed runs included
+def timed_job(job):
+    @wraps(job)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return job(*args, **kwargs)
+        finally:
+            record_job_timing(job.__name__, time.perf_counter() - started)
+
+    return timed
+
+
+# Lease of the scheduler leader -- the status jobs run in a single process of the cluster
+# It is a meta document that the leader renews, another process takes it over once it has
+# not been renewed for lease_seconds. Expiry uses the MongoDb clock ($$NOW), not the clocks
+# of the app hosts. Each new leader gets a higher token, used to fence off a former leader
+class LeaderLease:
+    def __init__(self, collection, lease_id, lease_seconds):
+        self.collection = collection
+        self.lease_id = lease_id
+        self.lease_seconds = lease_seconds
+        self.owner = None
+        self.owner_pid = None
+        self.token = None
+        self.valid_until = None
+
+    # Takes or renews the lease -- returns whether this process is the leader
+    def acquire(self):
+        if self.owner_pid != os.getpid():
+            # A forked worker is a process of its own
+            self.owner = "%s:%d:%s" % (socket.gethostname(), os.getpid(), ObjectId())
+            self.owner_pid = os.getpid()
+            self.step_down()
+
+        started = time.monotonic()
+        try:
+            lease = self.collection.find_one_and_update(
+                {
+                    "_id": self.lease_id,
+                    "$or": [
+                        {"owner": self.owner},
+                        {"$expr": {"$lt": ["$expires_at", "$$NOW"]}},
+                    ],
+                },
+                [
+                    {
+                        "$set": {
+                            "token": {
+                                "$cond": [
+                                    {"$eq": ["$owner", self.owner]},
+                                    "$token",
+                                    {"$add": [{"$ifNull": ["$token", 0]}, 1]},
+                                ]
+                            },
+                            "owner": self.owner,
+                            "expires_at": {"$add": ["$$NOW", self.lease_seconds * 1000]},
+                        }
+                    }
+                ],
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Held by another process -- the upsert found the lease document taken
+            lease = None
+        except PyMongoError as error:
+            app.logger.warning("Could not renew the scheduler lease: %s", error)
+            return self.is_leader()
+
+        if lease is None:
+            self.step_down()
+            return False
+
+        self.token = lease["token"]
+        # Counted from before the request, so it never ends after the stored expiry
+        self.valid_until = started + self.lease_seconds
+        return True
+
+    def is_leader(self):
+        return (
+            self.owner_pid == os.getpid()
+            and self.valid_until is not None
+            and time.monotonic() < self.valid_until
+        )
+
+    def step_down(self):
+        self.token = None
+        self.valid_until = None
+
+    # Gives the lease up, so that another process takes over without waiting -- at exit
+    def release(self):
+        if self.is_leader():
+            try:
+                self.collection.update_one(
+                    {"_id": self.lease_id, "owner": self.owner},
+                    [{"$set": {"expires_at": "$$NOW"}}],
+                )
+            except PyMongoError:
+                pass
+        self.step_down()
+
+
+LEADER_LEASE_ID = "scheduler_leader"
+leader_lease = LeaderLease(meta_collection, LEADER_LEASE_ID, LEADER_LEASE_SECONDS)
+atexit.register(leader_lease.release)
+
+
+# Runs a job only in the scheduler leader
+def leader_only(job):
+    @wraps(job)
+    def run_if_leader(*args, **kwargs):
+        if leader_lease.is_leader():
+            return job(*args, **kwargs)
+
+    return run_if_leader
+
+
+# Version of the quizzes -- bumped by every change, the ETags of the listings are built from it
+# It is stored in MongoDb for all the workers, each worker keeps a copy for a few seconds
+QUIZZES_VERSION_ID = "quizzes_version"
+quizzes_version_cache = {"version": None, "expires_at": 0.0}
+quizzes_version_lock = threading.Lock()
+
+
+# Copy of the quizzes version of this worker -- None when it must be read again
+def read_quizzes_version_cache():
+    with quizzes_version_lock:
+        if time.monotonic() < quizzes_version_cache["expires_at"]:
+            return quizzes_version_cache["version"]
+        return None
+
+
+def store_quizzes_version(version):
+    with quizzes_version_lock:
+        quizzes_version_cache["version"] = version
+        quizzes_version_cache["expires_at"] = time.monotonic() + QUIZZES_VERSION_MAX_AGE
+
+
+def get_quizzes_version():
+    version = read_quizzes_version_cache()
+    if version is None:
+        document = meta_collection.find_one({"_id": QUIZZES_VERSION_ID})
+        version = document["version"] if document else 0
+        store_quizzes_version(version)
+    return version
+
+
+# Called after the quizzes change -- new quizzes or status transitions
+def bump_quizzes_version():
+    document = meta_collection.find_one_and_update(
+        {"_id": QUIZZES_VERSION_ID},
+        {"$inc": {"version": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    store_quizzes_version(document["version"])
+
+
+# Time up to which the quiz status is known to be correct -- None until the first run
+# The leader also stores it in MongoDb, so that the next leader carries on from there
+status_watermark = None
+status_update_lock = threading.Lock()
+STATUS_WATERMARK_ID = "quiz_status"
+
+
+# Carries on from the watermark of the former leader -- when this process becomes the leader
+def load_status_watermark():
+    global status_watermark
+
+    document = meta_collection.find_one({"_id": STATUS_WATERMARK_ID})
+    with status_update_lock:
+        status_watermark = document["watermark"] if document else None
+
+
+# Stores the watermark with the token of the lease -- refused once a newer leader stored one,
+# this process then stops acting as the leader
+def store_status_watermark(watermark, token):
+    try:
+        meta_collection.update_one(
+            {"_id": STATUS_WATERMARK_ID, "token": {"$lte": token}},
+            {"$set": {"watermark": watermark, "token": token}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        app.logger.warning("Scheduler lease taken over by another process")
+        leader_lease.step_down()
+
+
+# Function to change the status of the quiz
+# Only quizzes whose start_date/end_date was crossed since the last run are written
+# Every quiz of that window is stamped with the lease token (status_token), whether its status
+# changes or not, and quizzes stamped by a newer leader are skipped: a former leader that
+# still runs cannot undo the status the new one checked
+# It returns the time up to which the status is now correct
+@timed_job
+def update_quiz_status():
+    global status_watermark
+
+    with status_update_lock:
+        now = datetime.now()
+
+        token = leader_lease.token
+        if token is None:
+            # Not the leader any more -- the next one carries on from the stored watermark
+            return now
+        fence = {"status_token": {"$not": {"$gt": token}}}
+
+        if status_watermark is None:
+            # First run -- every quiz is checked once
+            started = {"start_date": {"$lte": now}, "end_date": {"$gt": now}}
+            ended = {"$or": [{"end_date": {"$lte": now}}, {"start_date": {"$gt": now}}]}
+        else:
+            started = {
+                "start_date": {"$gt": status_watermark, "$lte": now},
+                "end_date": {"$gt": now},
+            }
+            ended = {"end_date": {"$gt": status_watermark, "$lte": now}}
+
+        # Status of quiz that has Started, then of quiz that has ended
+        changed = 0
+        for window, status in ((started, True), (ended, False)):
+            changed += quizzes_collection.update_many(
+                {**window, **fence, "status": {"$ne": status}},
+                {"$set": {"status": status, "status_token": token}},
+            ).modified_count
+
+            # The quizzes that already had the right status are only stamped
+            quizzes_collection.update_many(
+                {**window, "status_token": {"$not": {"$gte": token}}},
+                {"$set": {"status_token": token}},
+            )
+
+        if changed:
+            bump_quizzes_version()
+
+        store_status_watermark(now, token)
+        status_watermark = now
+        return now
+
+
+# Status of a quiz at the given time -- used when a quiz is stored
+def quiz_status_at(start_date, end_date, now):
+    return start_date <= now < end_date
+
+
+# Upcoming start_date/end_date values, as a min-heap
+# Boundaries after the horizon are not loaded yet -- None when all of them are loaded
+boundary_heap = []
+boundary_horizon = None
+boundary_lock = threading.Lock()
+BOUNDARY_JOB_ID = "quiz_boundary"
+
+
+# Loads the next boundaries after now from the database
+def load_quiz_boundaries(now):
+    global boundary_horizon
+
+    horizon = None
+    boundaries = set()
+    for field in ("start_date", "end_date"):
+        values = [
+            quiz[field]
+            for quiz in quizzes_collection.find({field: {"$gt": now}}, {field: 1})
+            .sort(field, 1)
+            .limit(BOUNDARY_BATCH_SIZE)
+        ]
+        if len(values) == BOUNDARY_BATCH_SIZE:
+            horizon = values[-1] if horizon is None else min(horizon, values[-1])
+        boundaries.update(values)
+
+    heap = [boundary for boundary in boundaries if horizon is None or boundary <= horizon]
+    heapq.heapify(heap)
+
+    with boundary_lock:
+        boundary_heap[:] = heap
+        boundary_horizon = horizon
+
+
+# Schedules a one-shot job at the earliest upcoming boundary
+def schedule_next_boundary():
+    with boundary_lock:
+        run_date = boundary_heap[0] if boundary_heap else boundary_horizon
+
+    if run_date is None:
+        return
+
+    scheduler.add_job(
+        on_quiz_boundary,
+        "date",
+        run_date=run_date,
+        id=BOUNDARY_JOB_ID,
+        replace_existing=True,
+        misfire_grace_time=None,
+    )
+
+
+# Runs when a quiz starts or ends
+@leader_only
+@timed_job
+def on_quiz_boundary():
+    updated_until = update_quiz_status()
+
+    with boundary_lock:
+        while boundary_heap and boundary_heap[0] <= updated_until:
+            heapq.heappop(boundary_heap)
+        reload = not boundary_heap and boundary_horizon is not None
+
+    if reload:
+        load_quiz_boundaries(updated_until)
+
+    schedule_next_boundary()
+
+
+# Adds the boundaries of new quizzes -- the job is moved if one of them comes first
+# Other processes leave them to the leader, which reads them when the quizzes version changes
+def add_quiz_boundaries(boundaries):
+    quiz_events.wake()
+
+    if not leader_lease.is_leader():
+        return
+
+    now = datetime.now()
+
+    with boundary_lock:
+        earliest = boundary_heap[0] if boundary_heap else None
+        for boundary in boundaries:
+            if boundary > now and (boundary_horizon is None or boundary <= boundary_horizon):
+                heapq.heappush(boundary_heap, boundary)
+        moved = boundary_heap and boundary_heap[0] != earliest
+
+    if moved:
+        schedule_next_boundary()
+
+
+# Full sync -- status of every crossed boundary, then the upcoming boundaries again
+@leader_only
+@timed_job
+def sync_quiz_status():
+    updated_until = update_quiz_status()
+    load_quiz_boundaries(updated_until)
+    schedule_next_boundary()
+
+
+# Status Updater -- syncs every few minutes, in between the status changes at the exact
+# start_date/end_date of each quiz. Only the scheduler leader runs these jobs
+scheduler.add_job(sync_quiz_status, "interval", minutes=STATUS_SYNC_MINUTES)
+
+# Quizzes version the leader last synced the status at
+leader_synced_version = None
+
+
+# Takes or renews the scheduler lease, in every process. A new leader carries on from the
+# stored watermark, and the leader syncs again whenever the quizzes change -- quizzes
+# created by other processes get their boundaries this way
+def leader_tick():
+    global leader_synced_version
+
+    was_leader = leader_lease.is_leader()
+    if not leader_lease.acquire():
+        if was_leader:
+            app.logger.warning("No longer the scheduler leader")
+            try:
+                scheduler.remove_job(BOUNDARY_JOB_ID)
+            except JobLookupError:
+                pass
+        return
+
+    if not was_leader:
+        app.logger.info("Scheduler leader, token %d", leader_lease.token)
+        load_status_watermark()
+        leader_synced_version = None
+
+    version = get_quizzes_version()
+    if version != leader_synced_version:
+        sync_quiz_status()
+        leader_synced_version = get_quizzes_version()
+
+
+scheduler.add_job(
+    leader_tick,
+    "interval",
+    seconds=LEADER_RENEW_SECONDS,
+    next_run_time=datetime.now(),
+)
+
+
+# Naive local time of an ISO 8601 date and time -- the dates of the quizzes are in local
+# time, like datetime.now(). It raises ValueError when the value is not a valid date
+def parse_local_datetime(value):
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return moment
+
+
+# Builds a Quiz from the submitted fields (JSON object or form data)
+# It raises ValueError with the reason when the data is not valid
+def build_quiz(data, now):
+    if not hasattr(data, "get"):
+        raise ValueError("Invalid request body. JSON object expected.")
+
+    question = data.get("question")
+    entered_options_data = data.get("options")
+    entered_right_answer = data.get("rightAnswer")
+    entered_start_date = data.get("startDate")
+    entered_end_date = data.get("endDate")
+
+    if (
+        entered_options_data is None
+        or entered_right_answer in (None, "")
+        or not entered_start_date
+        or not entered_end_date
+    ):
+        raise ValueError("Invalid request body. Missing Data.")
+
+    # A comma-separated string, or a list of options -- options_text keeps them joined
+    # by commas, so an option of a list cannot have one
+    if isinstance(entered_options_data, str):
+        entered_options_data = entered_options_data.split(",")
+    elif not isinstance(entered_options_data, list) or not all(
+        isinstance(option, str) and "," not in option for option in entered_options_data
+    ):
+        raise ValueError("Invalid options. Comma-separated string or list of strings expected.")
+    options = [option.strip() for option in entered_options_data]
+
+    try:
+        right_answer = int(entered_right_answer)
+        start_date = parse_local_datetime(entered_start_date)
+        end_date = parse_local_datetime(entered_end_date)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid request body. Invalid rightAnswer or date.")
+
+    if right_answer < 1 or right_answer > len(options):
+        raise ValueError("Invalid rightAnswer index")
+
+    if start_date >= end_date:
+        raise ValueError("End date must be a date after the start date")
+
+    # now = datetime.now()
+    # print(now, start_date, end_date)
+    # if start_date < now or end_date < now:
+    #     abort(400, 'Start date and end date must be a future date (Tomorrow)')
+
+    quiz = Quiz(question, options, right_answer, start_date, end_date)
+    # The status updater only looks at boundaries crossed after its last run
+    quiz.status = quiz_status_at(start_date, end_date, now)
+    return quiz
+
+
+# Projection used by the quiz listings
+QUIZ_SUMMARY_FIELDS = {"_id": 1, "question": 1, "options_text": 1}
+
+
+# Public view of a quiz in the listings -- id, question, options
+def quiz_summary(quiz):
+    options_text = quiz.get("options_text")
+    return {
+        "id": quiz["_id"],
+        "question": quiz["question"],
+        "options": options_text.split(",") if options_text is not None else quiz.get("options"),
+    }
+
+
+# Result of a quiz is released 5 minutes after its end_date
+RESULT_RELEASE_DELAY = timedelta(minutes=5)
+
+
+def result_release_time(quiz):
+    return quiz["end_date"] + RESULT_RELEASE_DELAY
+
+
+# Public view of a released quiz -- id, question, options, result
+def quiz_result(quiz):
+    return {
+        "id": quiz["_id"],
+        "question": quiz["question"],
+        "options": quiz["options"],
+        "result": quiz["right_answer"],
+    }
+
+
+# Streaming mode is asked with ?stream=1 or "Accept: application/x-ndjson"
+def wants_stream(request):
+    if request.args.get("stream") == "1":
+        return True
+
+    best = request.accept_mimetypes.best_match(
+        ["application/json", "application/x-ndjson"]
+    )
+    return best == "application/x-ndjson"
+
+
+# Streams the quizzes as NDJSON -- one quiz per line, nothing is buffered
+def stream_quizzes(quizzes):
+    def generate():
+        for quiz in quizzes:
+            yield app.json.dumps(quiz) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+# Reads ?after=<id>&limit=N of GET /quizzes/all -- returns the query and the page size
+# It raises ValueError with the reason when they are not valid
+def parse_page_args(args):
+    query = {}
+
+    after = args.get("after")
+    if after:
+        try:
+            query["_id"] = {"$gt": ObjectId(after)}
+        except InvalidId:
+            raise ValueError("Invalid cursor")
+
+    try:
+        limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("Invalid limit")
+
+    if limit < 1:
+        raise ValueError("Limit must be a positive number")
+
+    return query, limit
+
+
+# Page of GET /quizzes/all -- holds limit + 1 quizzes when another page exists
+# It returns the quizzes of the page and the Link header to the next page (None on the last)
+def quiz_page(quizzes, limit):
+    if len(quizzes) <= limit:
+        return quizzes, None
+
+    quizzes = quizzes[:limit]
+    return quizzes, '</quizzes/all?after=%s&limit=%d>; rel="next"' % (quizzes[-1]["id"], limit)
+
+
+# Node of the quiz schedule -- the quizzes whose [start_date, end_date] contains center,
+# sorted by start_date and by end_date. Quizzes that end before center are on its left,
+# quizzes that start after it on its right
+class ScheduleNode:
+    __slots__ = ("center", "starts", "by_start", "ends", "by_end", "left", "right")
+
+    def __init__(self, intervals):
+        endpoints = sorted([start for start, _, _ in intervals] + [end for _, end, _ in intervals])
+        self.center = endpoints[len(endpoints) // 2]
+
+        here, left, right = [], [], []
+        for interval in intervals:
+            if interval[1] < self.center:
+                left.append(interval)
+            elif interval[0] > self.center:
+                right.append(interval)
+            else:
+                here.append(interval)
+
+        here.sort(key=lambda interval: interval[0])
+        self.starts = [start for start, _, _ in here]
+        self.by_start = [quiz for _, _, quiz in here]
+        here.sort(key=lambda interval: interval[1])
+        self.ends = [end for _, end, _ in here]
+        self.by_end = [quiz for _, _, quiz in here]
+
+        # The center is an endpoint of a quiz kept here, so each side has fewer quizzes
+        self.left = ScheduleNode(left) if left else None
+        self.right = ScheduleNode(right) if right else None
+
+
+# Interval tree of a batch of quizzes, with their start and end dates in order for the
+# boundary and event lookups
+class ScheduleTree:
+    __slots__ = ("intervals", "root", "starts", "start_quizzes", "ends", "end_quizzes")
+
+    def __init__(self, intervals):
+        self.intervals = intervals
+        self.root = ScheduleNode(intervals)
+
+        by_start = sorted(intervals, key=lambda interval: interval[0])
+        self.starts = [start for start, _, _ in by_start]
+        self.start_quizzes = [quiz for _, _, quiz in by_start]
+        by_end = sorted(intervals, key=lambda interval: interval[1])
+        self.ends = [end for _, end, _ in by_end]
+        self.end_quizzes = [quiz for _, _, quiz in by_end]
+
+    # Boundaries of the quiz events -- (name, times, quizzes, delay after the time)
+    def event_boundaries(self):
+        return [
+            ("quiz_started", self.starts, self.start_quizzes, timedelta(0)),
+            ("quiz_ended", self.ends, self.end_quizzes, timedelta(0)),
+            ("result_released", self.ends, self.end_quizzes, RESULT_RELEASE_DELAY),
+        ]
+
+
+# Schedule of every quiz in memory -- the quizzes active at a time are found without MongoDb
+# Quizzes are kept in interval trees (a built tree is never changed) whose sizes halve from
+# one to the next: a new quiz is a tree of its own, merged with the last trees once it
+# outgrows them, so an add costs O(log n) amortized. A lookup is O(log n) per tree plus the
+# k quizzes found
+class QuizSchedule:
+    # Quizzes created by other workers are read again from a bit before the newest quiz
+    # read by a refresh, as ObjectIds made on other hosts are only roughly in order
+    REFRESH_OVERLAP = timedelta(minutes=1)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.trees = []
+        self.quizzes = {}
+        self.loaded_until = None
+        self.version = None
+        # Quizzes added since the last events_between with since -- (created, interval),
+        # kept once the event thread of this process runs
+        self.unannounced = None
+        self.unannounced_pid = None
+
+    # Adds quizzes (documents with the QUIZ_SCHEDULE_FIELDS) -- those already known are skipped
+    # version is the quizzes version they were read at, None for quizzes just created
+    def add(self, quizzes, version=None):
+        with self.lock:
+            intervals = []
+            for quiz in quizzes:
+                # Only a refresh read moves the high-water mark -- a quiz this worker just
+                # created may be newer than quizzes of other workers not read yet
+                if version is not None:
+                    created = quiz["_id"].generation_time
+                    if self.loaded_until is None or created > self.loaded_until:
+                        self.loaded_until = created
+
+                if quiz["_id"] in self.quizzes:
+                    continue
+
+                interval = (quiz["start_date"], quiz["end_date"], quiz_summary(quiz))
+                self.quizzes[quiz["_id"]] = interval
+                intervals.append(interval)
+                if self.unannounced_pid == os.getpid():
+                    self.unannounced.append((quiz["_id"].generation_time, interval))
+
+            if intervals:
+                self.trees.append(ScheduleTree(intervals))
+                while (
+                    len(self.trees) > 1
+                    and len(self.trees[-2].intervals) <= len(self.trees[-1].intervals)
+                ):
+                    merged = self.trees.pop().intervals + self.trees.pop().intervals
+                    self.trees.append(ScheduleTree(merged))
+
+            if version is not None:
+                self.version = version
+
+    def is_current(self, version):
+        return self.version == version
+
+    # Starts keeping the quizzes added from now on, for events_between with since
+    def track_added(self):
+        with self.lock:
+            self.unannounced = []
+            self.unannounced_pid = os.getpid()
+
+    # (start_date, end_date, summary) of a quiz -- None when it is not loaded
+    def get(self, quiz_id):
+        with self.lock:
+            return self.quizzes.get(quiz_id)
+
+    # Filter of the quizzes to read to catch up -- all of them on the first load
+    def refresh_filter(self):
+        with self.lock:
+            if self.loaded_until is None:
+                return {}
+            return {
+                "_id": {"$gte": ObjectId.from_datetime(self.loaded_until - self.REFRESH_OVERLAP)}
+            }
+
+    # Summaries of the quizzes active at the given time, by id
+    def active_at(self, at):
+        with self.lock:
+            roots = [tree.root for tree in self.trees]
+
+        quizzes = []
+        for node in roots:
+            while node is not None:
+                if at < node.center:
+                    # Every quiz here ends after at -- the ones started by then are active
+                    quizzes.extend(node.by_start[: bisect.bisect_right(node.starts, at)])
+                    node = node.left
+                else:
+                    # Every quiz here has started by at -- the ones not ended yet are active
+                    quizzes.extend(node.by_end[bisect.bisect_left(node.ends, at) :])
+                    node = node.right
+
+        quizzes.sort(key=lambda quiz: quiz["id"])
+        return quizzes
+
+    # Earliest time after at at which the set of active quizzes changes
+    def next_boundary(self, at):
+        with self.lock:
+            trees = list(self.trees)
+
+        upcoming = []
+        for tree in trees:
+            index = bisect.bisect_right(tree.starts, at)
+            if index < len(tree.starts):
+                upcoming.append(tree.starts[index])
+            index = bisect.bisect_left(tree.ends, at)
+            if index < len(tree.ends):
+                upcoming.append(tree.ends[index])
+
+        return min(upcoming, default=None)
+
+    # Quiz events after after and up to until -- (time, name, summary), in time order
+    # With since, the quizzes added since the last such call also get their events from their
+    # creation (but not before since) up to after: a quiz created on another worker is only
+    # loaded a while later, when the events it had then are already behind after
+    def events_between(self, after, until, since=None):
+        with self.lock:
+            trees = list(self.trees)
+            added = []
+            if since is not None and self.unannounced_pid == os.getpid():
+                added, self.unannounced = self.unannounced, []
+
+        events = []
+        for created, (start_date, end_date, quiz) in added:
+            created = max(created.astimezone().replace(tzinfo=None), since)
+            for name, moment in (
+                ("quiz_started", start_date),
+                ("quiz_ended", end_date),
+                ("result_released", end_date + RESULT_RELEASE_DELAY),
+            ):
+                if created < moment <= after:
+                    events.append((moment, name, quiz))
+
+        for tree in trees:
+            for name, times, quizzes, delay in tree.event_boundaries():
+                first = bisect.bisect_right(times, after - delay)
+                last = bisect.bisect_right(times, until - delay)
+                events.extend(
+                    (times[index] + delay, name, quizzes[index]) for index in range(first, last)
+                )
+
+        events.sort(key=lambda event: event[0])
+        return events
+
+    # Time of the first quiz event after after -- None when there is none
+    def next_event_time(self, after):
+        with self.lock:
+            trees = list(self.trees)
+
+        upcoming = []
+        for tree in trees:
+            for _, times, _, delay in tree.event_boundaries():
+                index = bisect.bisect_right(times, after - delay)
+                if index < len(times):
+                    upcoming.append(times[index] + delay)
+
+        return min(upcoming, default=None)
+
+
+QUIZ_SCHEDULE_FIELDS = {**QUIZ_SUMMARY_FIELDS, "start_date": 1, "end_date": 1}
+
+quiz_schedule = QuizSchedule()
+quiz_schedule_lock = threading.Lock()
+
+
+# Reads the quizzes created since the last load, when the quizzes version has changed
+# The first call loads every quiz
+def refresh_quiz_schedule():
+    with quiz_schedule_lock:
+        version = get_quizzes_version()
+        if not quiz_schedule.is_current(version):
+            quizzes = quizzes_collection.find(quiz_schedule.refresh_filter(), QUIZ_SCHEDULE_FIELDS)
+            quiz_schedule.add(quizzes, version)
+
+
+# The schedule is loaded on startup, and caught up with the other workers every few minutes
+scheduler.add_job(
+    refresh_quiz_schedule,
+    "interval",
+    minutes=STATUS_SYNC_MINUTES,
+    next_run_time=datetime.now(),
+)
+
+
+# Schedule entry of a quiz -- read from MongoDb when it is not loaded yet, None when not found
+def find_scheduled_quiz(quiz_object_id):
+    entry = quiz_schedule.get(quiz_object_id)
+    if entry is None:
+        quiz = quizzes_collection.find_one({"_id": quiz_object_id}, QUIZ_SCHEDULE_FIELDS)
+        if quiz:
+            quiz_schedule.add([quiz])
+            entry = quiz_schedule.get(quiz_object_id)
+    return entry
+
+
+# Events of a client of a stream, pushed by a background thread -- the client is dropped
+# (and reconnects) when maxsize events still wait as more come, so a slow client never
+# holds back the others. A batch larger than maxsize is still taken by a client that keeps
+# up. notify is called after each push to wake the client's event loop
+class EventSubscriber:
+    def __init__(self, maxsize, notify):
+        self.maxsize = maxsize
+        self.notify = notify
+        self.events = deque()
+        self.dropped = False
+        self.lock = threading.Lock()
+
+    # Adds events -- False once the client is dropped
+    def push(self, events):
+        with self.lock:
+            if len(self.events) >= self.maxsize:
+                self.dropped = True
+                self.events.clear()
+            elif not self.dropped:
+                self.events.extend(events)
+
+        self.notify()
+        return not self.dropped
+
+    # Events waiting
+    def pop(self):
+        with self.lock:
+            events = list(self.events)
+            self.events.clear()
+            return events
+
+
+# GET /quizzes/events of the ASGI app -- events a client can fall behind by, and seconds
+# between keep-alives
+QUIZ_EVENTS_QUEUE_SIZE = int(os.environ.get("QUIZ_EVENTS_QUEUE_SIZE", "1000"))
+QUIZ_EVENTS_KEEPALIVE_SECONDS = 15
+
+
+# Sends quiz_started, quiz_ended and result_released to every client of GET /quizzes/events
+# One thread per worker wakes at each start_date, end_date and result release of the quiz
+# schedule -- the transitions update_quiz_status applies -- and pushes the events to the
+# clients. It also wakes every few seconds to read the quizzes of the other workers -- their
+# events since they were created are sent when they are loaded, late rather than never
+class QuizEventBroadcaster:
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.subscribers = set()
+        self.condition = threading.Condition()
+        self.watermark = None
+        self.started = None
+        self.thread_pid = None
+
+    def subscribe(self, subscriber):
+        with self.condition:
+            if self.thread_pid != os.getpid():
+                self.thread_pid = os.getpid()
+                self.subscribers = set()
+                self.started = self.watermark = datetime.now()
+                self.schedule.track_added()
+                threading.Thread(target=self.run, name="quiz-events", daemon=True).start()
+            self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        with self.condition:
+            self.subscribers.discard(subscriber)
+
+    # Called when quizzes are created -- one may start before the time the thread waits for
+    def wake(self):
+        with self.condition:
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            try:
+                refresh_quiz_schedule()
+            except PyMongoError as error:
+                app.logger.warning("Could not read the new quizzes: %s", error)
+
+            with self.condition:
+                timeout = QUIZZES_VERSION_MAX_AGE
+                next_event = self.schedule.next_event_time(self.watermark)
+                if next_event is not None:
+                    timeout = min(timeout, (next_event - datetime.now()).total_seconds())
+                if timeout > 0:
+                    self.condition.wait(timeout)
+
+                after, self.watermark = self.watermark, datetime.now()
+                subscribers = list(self.subscribers)
+
+            events = [
+                {"event": name, "at": moment, **quiz}
+                for moment, name, quiz in self.schedule.events_between(
+                    after, self.watermark, self.started
+                )
+            ]
+            if not events:
+                continue
+
+            for subscriber in subscribers:
+                if not subscriber.push(events):
+                    self.unsubscribe(subscriber)
+
+
+quiz_events = QuizEventBroadcaster(quiz_schedule)
+
+
+# One Server-Sent Event
+def sse_message(event):
+    return "event: %s\ndata: %s\n\n" % (event["event"], app.json.dumps(event))
+
+
+# Time of ?at= of GET /quizzes/active -- None when not given
+# It raises ValueError when it is not an ISO 8601 date and time
+def parse_at_arg(args):
+    at = args.get("at")
+    if at is None:
+        return None
+
+    try:
+        return parse_local_datetime(at)
+    except ValueError:
+        raise ValueError("Invalid at. ISO 8601 date and time expected.")
+
+
+# Cache of the active quizzes -- the active set only changes at a start_date/end_date
+# boundary, so the payload is kept until the next boundary (or a new quiz is created)
+active_quiz_cache = {"quizzes": None, "body": None, "expires_at": None, "generation": 0}
+active_quiz_cache_lock = threading.Lock()
+
+
+# Cached active quizzes and their JSON body -- (None, None, generation) when not valid
+# The generation is handed back to store_active_quiz_cache
+def read_active_quiz_cache(now):
+    with active_quiz_cache_lock:
+        if active_quiz_cache["body"] is not None and now < active_quiz_cache["expires_at"]:
+            metric_counters.add(("quizapi_cache_hits_total", 'cache="active"'))
+            return active_quiz_cache["quizzes"], active_quiz_cache["body"], None
+
+        metric_counters.add(("quizapi_cache_misses_total", 'cache="active"'))
+        return None, None, active_quiz_cache["generation"]
+
+
+# Keeps the active quizzes computed at now until the next boundary
+def store_active_quiz_cache(generation, quizzes, body, now, boundary):
+    expires_at = now + timedelta(seconds=ACTIVE_QUIZ_CACHE_MAX_AGE)
+    if boundary is not None:
+        expires_at = min(expires_at, boundary)
+
+    with active_quiz_cache_lock:
+        # A quiz created meanwhile makes this result stale -- it is not stored
+        if active_quiz_cache["generation"] == generation:
+            active_quiz_cache["quizzes"] = quizzes
+            active_quiz_cache["body"] = body
+            active_quiz_cache["expires_at"] = expires_at
+
+
+# Returns the active quizzes and their JSON body, from the cache when still valid
+def get_active_quiz_payload():
+    now = datetime.now()
+
+    quizzes, body, generation = read_active_quiz_cache(now)
+    if body is not None:
+        return quizzes, body
+
+    refresh_quiz_schedule()
+    quizzes = quiz_schedule.active_at(now)
+    body = app.json.dumps(quizzes)
+
+    store_active_quiz_cache(generation, quizzes, body, now, quiz_schedule.next_boundary(now))
+    return quizzes, body
+
+
+# Drops the cached active quizzes -- called when the quizzes change
+def invalidate_active_quiz_cache():
+    with active_quiz_cache_lock:
+        active_quiz_cache["generation"] += 1
+        active_quiz_cache["quizzes"] = None
+        active_quiz_cache["body"] = None
+        active_quiz_cache["expires_at"] = None
+
+
+# Answers waiting to be written -- a writer thread sends them with insert_many. The thread
+# is started on first use in each process, as threads do not survive a fork
+# on_written is called with the answers of each batch that were written
+class AnswerBuffer:
+    def __init__(self, collection, flush_ms, batch_size, max_pending, on_written=None):
+        self.collection = collection
+        self.on_written = on_written
+        self.flush_seconds = flush_ms / 1000
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.pending = []
+        self.condition = threading.Condition()
+        self.writer_pid = None
+        self.written = 0
+        self.duplicates = 0
+        self.refused = 0
+
+    # Queues an answer -- False when too many answers are waiting already
+    def put(self, answer):
+        with self.condition:
+            if self.writer_pid != os.getpid():
+                # Answers queued before a fork are written by the parent
+                self.pending = []
+                self.writer_pid = os.getpid()
+                threading.Thread(target=self.run, name="answer-writer", daemon=True).start()
+
+            if len(self.pending) >= self.max_pending:
+                self.refused += 1
+                return False
+
+            self.pending.append(answer)
+            if len(self.pending) in (1, self.batch_size):
+                self.condition.notify()
+            return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                if len(self.pending) < self.batch_size:
+                    self.condition.wait(self.flush_seconds)
+                batch, self.pending = self.pending, []
+
+            if not self.write(batch):
+                time.sleep(self.flush_seconds)
+
+    # Writes a batch -- it is queued again when MongoDb cannot be reached
+    def write(self, batch):
+        try:
+            self.collection.insert_many(batch, ordered=False)
+            write_errors = []
+        except BulkWriteError as error:
+            write_errors = error.details.get("writeErrors", [])
+        except PyMongoError as error:
+            app.logger.warning("Could not write %d answers: %s", len(batch), error)
+            with self.condition:
+                self.pending[:0] = batch
+            return False
+
+        failed = set()
+        duplicates = 0
+        for write_error in write_errors:
+            if write_error["code"] != 11000:
+                app.logger.error("Answer not written: %s", write_error["errmsg"])
+            elif write_error.get("keyPattern") == {"_id": 1}:
+                # A retried answer that was written by the failed attempt
+                continue
+            else:
+                duplicates += 1
+            failed.add(write_error["index"])
+
+        written = [answer for index, answer in enumerate(batch) if index not in failed]
+        if self.on_written is not None:
+            self.on_written(written)
+
+        with self.condition:
+            self.written += len(written)
+            self.duplicates += duplicates
+        return True
+
+    # Writes the answers still waiting -- called when the process exits
+    def close(self):
+        with self.condition:
+            batch, self.pending = self.pending, []
+        if batch:
+            self.write(batch)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "pending": len(self.pending),
+                "written": self.written,
+                "duplicates": self.duplicates,
+                "refused": self.refused,
+            }
+
+
+# Written answers counted by quiz and option, not yet added to MongoDb
+# Quizzes are spread over lock stripes, so threads counting different quizzes rarely wait
+# Counts being written stay in the in-flight map of their stripe until the write is settled
+class TallyCounter:
+    STRIPES = 16
+
+    def __init__(self):
+        self.stripes = [(threading.Lock(), {}, {}) for _ in range(self.STRIPES)]
+        # Number of settled flushes -- a stored tally read during a flush is not cached
+        self.flushes = 0
+
+    def stripe(self, quiz_id):
+        return self.stripes[hash(quiz_id) % self.STRIPES]
+
+    def add(self, quiz_id, answer, value=1):
+        lock, counts, _ = self.stripe(quiz_id)
+        with lock:
+            merge_counts(counts, {quiz_id: {answer: value}})
+
+    def add_answers(self, answers):
+        for answer in answers:
+            self.add(answer["quiz_id"], answer["answer"])
+
+    # Counts of a quiz not in MongoDb yet, the in-flight ones included -- {option index: n}
+    def pending(self, quiz_id):
+        lock, counts, in_flight = self.stripe(quiz_id)
+        with lock:
+            options = dict(counts.get(quiz_id, {}))
+            for answer, value in in_flight.get(quiz_id, {}).items():
+                options[answer] = options.get(answer, 0) + value
+            return options
+
+    # Moves every count not written yet to in-flight and returns them -- {quiz id: {option index: n}}
+    def take(self):
+        taken = {}
+        for lock, counts, in_flight in self.stripes:
+            with lock:
+                merge_counts(in_flight, counts)
+                taken.update(counts)
+                counts.clear()
+        return taken
+
+    # Ends the write of taken counts -- the failed quizzes are counted again for the next flush
+    def settle(self, taken, failed=()):
+        for quiz_id, options in taken.items():
+            lock, counts, in_flight = self.stripe(quiz_id)
+            with lock:
+                merge_counts(in_flight, {quiz_id: options}, -1)
+                if quiz_id in failed:
+                    merge_counts(counts, {quiz_id: options})
+        self.flushes += 1
+
+
+# Adds counts -- {quiz id: {option index: n}} -- to others, sign -1 takes them off
+def merge_counts(counts, added, sign=1):
+    for quiz_id, options in added.items():
+        merged = counts.setdefault(quiz_id, {})
+        for answer, value in options.items():
+            merged[answer] = merged.get(answer, 0) + sign * value
+            if not merged[answer]:
+                del merged[answer]
+        if not merged:
+            del counts[quiz_id]
+
+
+tally_counter = TallyCounter()
+
+
+# Adds the counts of this worker to the tallies in MongoDb, one $inc per quiz
+# Counts whose write failed are kept for the next flush. The counts being written stay
+# in pending() until the cached tallies are discarded, so a tally never goes back
+def flush_tallies():
+    taken = tally_counter.take()
+    if not taken:
+        return
+
+    quiz_ids = list(taken)
+    requests = [
+        UpdateOne(
+            {"_id": quiz_id},
+            {
+                "$inc": {
+                    **{"counts.%d" % answer: value for answer, value in taken[quiz_id].items()},
+                    "total": sum(taken[quiz_id].values()),
+                }
+            },
+            upsert=True,
+        )
+        for quiz_id in quiz_ids
+    ]
+
+    failed = set()
+    try:
+        tallies_collection.bulk_write(requests, ordered=False)
+    except BulkWriteError as error:
+        failed = {
+            quiz_ids[write_error["index"]]
+            for write_error in error.details.get("writeErrors", [])
+        }
+    except PyMongoError as error:
+        app.logger.warning("Could not write the tallies of %d quizzes: %s", len(taken), error)
+        tally_counter.settle(taken, failed=taken)
+        return
+
+    # The cached tallies miss the counts just written -- they are read again
+    for quiz_id in quiz_ids:
+        if quiz_id not in failed:
+            tally_cache.discard(quiz_id)
+    tally_counter.settle(taken, failed)
+
+
+# Caches a stored tally -- unless a flush was settled since flushes was read before the query,
+# as the tally may miss counts that pending() no longer has
+def cache_stored_tally(quiz_id, stored, flushes, expires_at):
+    if tally_counter.flushes == flushes:
+        tally_cache.set(quiz_id, stored, expires_at)
+
+
+scheduler.add_job(flush_tallies, "interval", seconds=TALLY_FLUSH_SECONDS)
+# Registered before the answer buffer -- its last answers are counted before this runs at exit
+atexit.register(flush_tallies)
+
+# Tally of a quiz -- the stored counts (None when nothing is stored) plus this worker's pending ones
+def quiz_tally(quiz_object_id, summary, stored):
+    counts = {int(answer): value for answer, value in (stored or {}).get("counts", {}).items()}
+    for answer, value in tally_counter.pending(quiz_object_id).items():
+        counts[answer] = counts.get(answer, 0) + value
+
+    return {
+        "id": quiz_object_id,
+        "options": summary["options"],
+        "counts": [counts.get(answer, 0) for answer in range(1, len(summary["options"]) + 1)],
+        "total": sum(counts.values()),
+    }
+
+
+answer_buffer = AnswerBuffer(
+    answers_collection,
+    ANSWER_FLUSH_MS,
+    ANSWER_BATCH_SIZE,
+    MAX_PENDING_ANSWERS,
+    on_written=tally_counter.add_answers,
+)
+atexit.register(answer_buffer.close)
+
+
+# Answer document of a submission to the quiz of the given schedule entry
+# It aborts with 404 for an unknown quiz, 403 when the quiz is not active
+# (same window as GET /quizzes/active) and 400 when the body is not valid
+def build_answer(quiz_object_id, entry, data, now):
+    if entry is None:
+        abort(404, "Quiz not found")
+
+    start_date, end_date, summary = entry
+    if not start_date <= now <= end_date:
+        abort(403, "Quiz is not active")
+
+    if not isinstance(data, dict):
+        abort(400, "Invalid request body. JSON object expected.")
 
+    participant = data.get("participant")
+    answer = data.get("answer")
 
-# Flask app is created
-app = Flask(__name__)
+    if isinstance(participant, bool) or not isinstance(participant, (str, int)) or participant == "":
+        abort(400, "Invalid request body. Missing participant.")
 
-# Limiter to limit the requests from a single IP address
-limiter = Limiter(
-    get_remote_address,
-    app=app,
-    default_limits=["1000 per day"],
-    storage_uri="memory://",
-)
+    if not isinstance(answer, int) or isinstance(answer, bool):
+        abort(400, "Invalid request body. Invalid answer.")
 
-# MongoDb configuration
-mongo_client = MongoClient(os.environ.get("MONGODB_CONNECTION_URL"))
-db = mongo_client["timed_quiz"]
-quizzes_collection = db["quizzes"]
+    if answer < 1 or answer > len(summary["options"]):
+        abort(400, "Invalid answer index")
 
-# Background task that updates the Status of the Quiz -- Active or Not
-scheduler = BackgroundScheduler()
-scheduler.start()
+    return {
+        "quiz_id": quiz_object_id,
+        "participant": str(participant),
+        "answer": answer,
+        "submitted_at": now,
+    }
 
 
-# Function to change the status of the quiz
-def update_quiz_status():
-    now = datetime.now()
+# Bounded LRU cache -- the least recently used entry is evicted when it is full
+# An entry can also be given an expiry time, it is dropped once that time has passed
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires_at = entry
+            if expires_at is not None and datetime.now() >= expires_at:
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires_at=None):
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+# JSON body of the released results by quiz id -- a released result never changes
+result_cache = LRUCache(RESULT_CACHE_SIZE)
+
+
+# Quiz ids whose result was refused -- "missing" (404) for a few seconds,
+# or the time the result is released (403) until that time
+negative_result_cache = LRUCache(NEGATIVE_RESULT_CACHE_SIZE)
+
+
+# Tallies read from MongoDb by quiz id, kept until the next flush
+tally_cache = LRUCache(TALLY_CACHE_SIZE)
+
+
+# State of a quiz result from the caches -- None when MongoDb must be read
+# ("released", body), ("missing", None) or ("release_at", None) otherwise
+def cached_result_state(quiz_id):
+    body = result_cache.get(quiz_id)
+    if body is not None:
+        return "released", body
+
+    refusal = negative_result_cache.get(quiz_id)
+    if refusal is not None:
+        return refusal, None
+
+    return None
 
-    # Status of quiz that has Started
-    quizzes_collection.update_many(
-        {"start_date": {"$lte": now}}, {"$set": {"status": True}}
+
+# State of a quiz result read from MongoDb (quiz is None when not found), kept in the caches
+def store_result_state(quiz_id, quiz, now):
+    if not quiz:
+        negative_result_cache.set(
+            quiz_id, "missing", now + timedelta(seconds=MISSING_RESULT_TTL)
+        )
+        return "missing", None
+
+    if now < result_release_time(quiz):
+        negative_result_cache.set(quiz_id, "release_at", result_release_time(quiz))
+        return "release_at", None
+
+    body = app.json.dumps(quiz_result(quiz))
+    result_cache.set(quiz_id, body)
+    return "released", body
+
+
+# Answers a refused result with its error -- 404 when not found, 403 when not released yet
+def abort_refused_result(state):
+    if state == "missing":
+        abort(404, "Quiz result not found")
+    if state == "release_at":
+        abort(403, "Result not available yet! Try after the quiz has ended.")
+
+
+# Response of a released result -- clients and CDNs can keep it for good
+def released_result_response(body, response_class=Response):
+    response = response_class(body, mimetype="application/json")
+    response.cache_control.public = True
+    response.cache_control.max_age = RESULT_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+# Strong ETag of a listing -- the quizzes version and the representation sent
+def listing_etag(listing, version, stream):
+    return "%s-%d-%s" % (listing, version, "ndjson" if stream else "json")
+
+
+# Empty 304 answer for a client that already has the current listing
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+# Timings of the requests of this worker, by route
+request_timings = {}
+request_timings_lock = threading.Lock()
+
+
+def record_request_timing(route, total_seconds, mongo_stats, response_bytes):
+    with request_timings_lock:
+        timing = request_timings.get(route)
+        if timing is None:
+            timing = request_timings[route] = {
+                "total_seconds": Histogram(),
+                "mongo_seconds": Histogram(),
+                "mongo_commands": 0,
+                "documents": 0,
+                "response_bytes": 0,
+            }
+
+        timing["total_seconds"].observe(total_seconds)
+        timing["mongo_seconds"].observe(mongo_stats["mongo_seconds"])
+        timing["mongo_commands"] += mongo_stats["commands"]
+        timing["documents"] += mongo_stats["documents"]
+        timing["response_bytes"] += response_bytes or 0
+
+
+def request_timings_snapshot():
+    with request_timings_lock:
+        return {
+            route: {
+                name: value.snapshot() if isinstance(value, Histogram) else value
+                for name, value in timing.items()
+            }
+            for route, timing in request_timings.items()
+        }
+
+
+# Starts the timing of a request -- the MongoDb commands it sends are counted from now on
+def start_request_timing():
+    request_mongo_stats.set({"mongo_seconds": 0.0, "commands": 0, "documents": 0})
+    return time.perf_counter()
+
+
+# Ends the timing of a request and adds the Server-Timing header to its response
+# A streamed body is sent after this point, its time and size are not part of the timing
+def finish_request_timing(route, started, response):
+    total_seconds = time.perf_counter() - started
+    mongo_stats = request_mongo_stats.get()
+    request_mongo_stats.set(None)
+
+    record_request_timing(route, total_seconds, mongo_stats, response.content_length)
+
+    response.headers["Server-Timing"] = "app;dur=%.3f, mongo;dur=%.3f" % (
+        total_seconds * 1000,
+        mongo_stats["mongo_seconds"] * 1000,
     )
 
-    # Status of quiz that has ended
-    quizzes_collection.update_many(
-        {"end_date": {"$lte": now}}, {"$set": {"status": False}}
+
+# Counts the requests refused by the rate limiter
+def count_rate_limited(route, response):
+    if response.status_code == 429:
+        metric_counters.add(("quizapi_rate_limited_total", metric_labels(route=route)))
+
+
+# Prometheus metrics -- by default /metrics only has the numbers of the worker that answers
+# With METRICS_DIR set, every worker writes its numbers to a file of that directory every few
+# seconds and /metrics adds up all the files. The directory should be emptied on each deploy
+METRICS_DIR = os.environ.get("METRICS_DIR")
+METRICS_FLUSH_SECONDS = int(os.environ.get("METRICS_FLUSH_SECONDS", "5"))
+
+# Exported metrics -- name: (type, help)
+METRICS = {
+    "quizapi_http_requests_total": ("counter", "Requests handled, by route."),
+    "quizapi_http_request_duration_seconds": ("histogram", "Time to handle a request, by route."),
+    "quizapi_http_request_mongo_seconds": ("histogram", "MongoDb time of a request, by route."),
+    "quizapi_rate_limited_total": ("counter", "Requests refused by the rate limiter, by route."),
+    "quizapi_job_duration_seconds": ("histogram", "Duration of the scheduled jobs, by job."),
+    "quizapi_mongo_pool_checkouts_total": ("counter", "Connections checked out of the pool."),
+    "quizapi_mongo_pool_checkout_failures_total": ("counter", "Failed connection checkouts."),
+    "quizapi_mongo_pool_checkout_wait_seconds": ("histogram", "Wait for a pool connection."),
+    "quizapi_mongo_pool_connections_in_use": ("gauge", "Pool connections checked out."),
+    "quizapi_cache_hits_total": ("counter", "Cache hits, by cache."),
+    "quizapi_cache_misses_total": ("counter", "Cache misses, by cache."),
+    "quizapi_cache_hit_ratio": ("gauge", "Hits over lookups since start, by cache."),
+    "quizapi_cache_entries": ("gauge", "Entries held by the cache, by cache."),
+    "quizapi_scheduler_leader": ("gauge", "Processes running the status jobs (1 when healthy)."),
+    "quizapi_answers_pending": ("gauge", "Answers waiting to be written."),
+    "quizapi_answers_written_total": ("counter", "Answers written to MongoDb."),
+    "quizapi_answers_duplicate_total": ("counter", "Answers dropped as a participant answered already."),
+    "quizapi_answers_refused_total": ("counter", "Answers refused as too many were waiting."),
+}
+
+
+# Labels of a sample in the Prometheus text format -- name="value",...
+def metric_labels(**labels):
+    return ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels.items()
     )
 
 
-# Status Updater -- runs every 5 minutes
-scheduler.add_job(update_quiz_status, "interval", minutes=1)
+# One line of the Prometheus text format
+def metric_sample(name, labels, value):
+    if labels:
+        return "%s{%s} %s" % (name, labels, value)
+    return "%s %s" % (name, value)
+
+
+# Metrics of this worker -- name: {labels: value}, a histogram value is its snapshot
+def metrics_snapshot():
+    metrics = {name: {} for name in METRICS}
+
+    for route, timing in request_timings_snapshot().items():
+        labels = metric_labels(route=route)
+        metrics["quizapi_http_requests_total"][labels] = timing["total_seconds"]["count"]
+        metrics["quizapi_http_request_duration_seconds"][labels] = timing["total_seconds"]
+        metrics["quizapi_http_request_mongo_seconds"][labels] = timing["mongo_seconds"]
+
+    for job, histogram in job_timings_snapshot().items():
+        metrics["quizapi_job_duration_seconds"][metric_labels(job=job)] = histogram
+
+    pool = pool_stats.snapshot()
+    metrics["quizapi_mongo_pool_checkouts_total"][""] = pool["checkouts"]
+    metrics["quizapi_mongo_pool_checkout_failures_total"][""] = pool["checkout_failures"]
+    metrics["quizapi_mongo_pool_checkout_wait_seconds"][""] = pool["checkout_wait"]
+    metrics["quizapi_mongo_pool_connections_in_use"][""] = pool["connections_in_use"]
+
+    for cache_name, cache in (("results", result_cache), ("refusals", negative_result_cache)):
+        labels = metric_labels(cache=cache_name)
+        stats = cache.stats()
+        metrics["quizapi_cache_hits_total"][labels] = stats["hits"]
+        metrics["quizapi_cache_misses_total"][labels] = stats["misses"]
+        metrics["quizapi_cache_entries"][labels] = stats["size"]
+
+    metrics["quizapi_scheduler_leader"][""] = int(leader_lease.is_leader())
+
+    answers = answer_buffer.stats()
+    metrics["quizapi_answers_pending"][""] = answers["pending"]
+    metrics["quizapi_answers_written_total"][""] = answers["written"]
+    metrics["quizapi_answers_duplicate_total"][""] = answers["duplicates"]
+    metrics["quizapi_answers_refused_total"][""] = answers["refused"]
+
+    for (name, labels), value in metric_counters.totals().items():
+        metrics[name][labels] = value
+
+    return metrics
+
+
+# Writes the metrics of this worker to its file of METRICS_DIR
+# The file is replaced at once so that a reader never sees half of it
+def write_metrics_file():
+    path = os.path.join(METRICS_DIR, "%d.json" % os.getpid())
+    with open(path + ".tmp", "w") as metrics_file:
+        metrics_file.write(app.json.dumps(metrics_snapshot()))
+    os.replace(path + ".tmp", path)
+
+
+# Metrics of every worker -- only this worker when METRICS_DIR is not set
+def worker_metrics():
+    if not METRICS_DIR:
+        return [metrics_snapshot()]
+
+    write_metrics_file()
+
+    snapshots = []
+    stale_before = time.time() - 3 * METRICS_FLUSH_SECONDS
+    for file_name in os.listdir(METRICS_DIR):
+        if not file_name.endswith(".json"):
+            continue
+
+        path = os.path.join(METRICS_DIR, file_name)
+        try:
+            with open(path) as metrics_file:
+                snapshot = app.json.loads(metrics_file.read())
+            modified = os.path.getmtime(path)
+        except (OSError, ValueError):
+            continue
+
+        if modified < stale_before:
+            # A worker that has exited -- its counters still count, its gauges do not
+            snapshot = {
+                name: samples
+                for name, samples in snapshot.items()
+                if name in METRICS and METRICS[name][0] != "gauge"
+            }
+        snapshots.append(snapshot)
+
+    return snapshots
+
+
+# Adds up the metrics of the workers, then computes the hit ratios from the totals
+def merge_metrics(snapshots):
+    merged = {name: {} for name in METRICS}
+
+    for snapshot in snapshots:
+        for name, samples in snapshot.items():
+            if name not in merged:
+                continue
+
+            for labels, value in samples.items():
+                if isinstance(value, dict):
+                    total = merged[name].setdefault(
+                        labels,
+                        {"count": 0, "sum": 0.0, "buckets": dict.fromkeys(value["buckets"], 0)},
+                    )
+                    total["count"] += value["count"]
+                    total["sum"] += value["sum"]
+                    for bound, count in value["buckets"].items():
+                        total["buckets"][bound] += count
+                else:
+                    merged[name][labels] = merged[name].get(labels, 0) + value
+
+    for labels, hits in merged["quizapi_cache_hits_total"].items():
+        lookups = hits + merged["quizapi_cache_misses_total"].get(labels, 0)
+        merged["quizapi_cache_hit_ratio"][labels] = hits / lookups if lookups else 0.0
+
+    return merged
+
+
+# Metrics of all the workers in the Prometheus text format
+def metrics_text():
+    metrics = merge_metrics(worker_metrics())
+    lines = []
+
+    for name, (kind, help_text) in METRICS.items():
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, kind))
+
+        for labels, value in sorted(metrics[name].items()):
+            if kind != "histogram":
+                lines.append(metric_sample(name, labels, value))
+                continue
+
+            for bound, count in value["buckets"].items():
+                bucket_labels = ",".join(filter(None, [labels, 'le="%s"' % bound]))
+                lines.append(metric_sample(name + "_bucket", bucket_labels, count))
+            lines.append(metric_sample(name + "_sum", labels, value["sum"]))
+            lines.append(metric_sample(name + "_count", labels, value["count"]))
+
+    return "\n".join(lines) + "\n"
+
+
+if METRICS_DIR:
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    scheduler.add_job(write_metrics_file, "interval", seconds=METRICS_FLUSH_SECONDS)
+
+
+@app.before_request
+def start_timer():
+    g.request_started = start_request_timing()
+
+
+@app.after_request
+def stop_timer(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    count_rate_limited(route, response)
+
+    # The limiter can refuse the request before the timer starts
+    if "request_started" in g:
+        finish_request_timing(route, g.request_started, response)
+    return response
 
 
 # Api home page -- documentation
@@ -81,137 +2177,490 @@ def create_quiz():
         if data is None:
             abort(400, "Invalid request body. JSON data expected.")
 
-        question = data.get("question")
-        options_raw = data.get("options")
-        options = [option.strip() for option in options_raw.split(",")]
-        right_answer = int(data.get("rightAnswer"))
-        start_date = datetime.fromisoformat(data.get("startDate"))
-        end_date = datetime.fromisoformat(data.get("endDate"))
-
     elif (
         request.headers["Content-Type"] == "application/x-www-form-urlencoded"
     ):  # Form data
-        form_data = request.form
-        question = request.form.get("question")
-        entered_right_answer = request.form.get("rightAnswer")
-        entered_options_data = str(request.form.get("options"))
-        entered_start_date = request.form.get("startDate")
-        entered_end_date = request.form.get("endDate")
-
-        if (
-            entered_right_answer == ""
-            or entered_start_date == ""
-            or entered_end_date == ""
-            or entered_options_data is None
-            and data is None
-        ):
-            abort(400, "Invalid request body. Missing Data.")
-
-        options = [option.strip() for option in entered_options_data.split(",")]
-        right_answer = int(entered_right_answer)
-        start_date = datetime.fromisoformat(entered_start_date)
-        end_date = datetime.fromisoformat(entered_end_date)
+        data = request.form
 
     else:
         abort(400, "Unsupported Media Type or empty body")
 
-    if right_answer < 1 or right_answer > len(options):
-        abort(400, "Invalid rightAnswer index")
-
-    if start_date >= end_date:
-        abort(400, "End date must be a date after the start date")
-
-    # now = datetime.now()
-    # print(now, start_date, end_date)
-    # if start_date < now or end_date < now:
-    #     abort(400, 'Start date and end date must be a future date (Tomorrow)')
+    try:
+        quiz = build_quiz(data, datetime.now())
+    except ValueError as error:
+        abort(400, str(error))
 
     # Store the Quiz in the MongoDb database
-    quiz = Quiz(question, options, right_answer, start_date, end_date)
     result = quizzes_collection.insert_one(quiz.__dict__)
     quiz.id = str(result.inserted_id)
-
-    # print(quiz.__dict__)
+    quiz_schedule.add([quiz.__dict__])
+    invalidate_active_quiz_cache()
+    bump_quizzes_version()
+    add_quiz_boundaries([quiz.start_date, quiz.end_date])
 
     return jsonify({"id": quiz.id}), 201
 
 
 # 2. GET /quizzes/active - to retrieve the active quiz  -- limit of 10 per minute
 # It return the data of all active Quizzes  -- id, question, options
+# The payload is served from memory until the next quiz starts or ends
+# An If-None-Match with the current ETag is answered with 304, without reading the quizzes
+# ?at=<ISO 8601 date and time> gives the quizzes active at that time instead -- to preview a schedule
 @app.route("/quizzes/active", methods=["GET"])
 @limiter.limit("10 per minute")
 def get_active_quiz():
-    now = datetime.now()
+    try:
+        at = parse_at_arg(request.args)
+    except ValueError as error:
+        abort(400, str(error))
 
-    active_quiz = quizzes_collection.find(
-        {"start_date": {"$lte": now}, "end_date": {"$gte": now}},
-        {"_id": 1, "question": 1, "options": 1},
-    )
+    stream = wants_stream(request)
+    listing = "active" if at is None else "active@" + at.isoformat()
+    etag = listing_etag(listing, get_quizzes_version(), stream)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
 
-    return jsonify(
-        [
-            {
-                "id": str(quiz["_id"]),
-                "question": quiz["question"],
-                "options": quiz["options"],
-            }
-            for quiz in active_quiz
-        ]
-    )
+    if at is None:
+        quizzes, body = get_active_quiz_payload()
+    else:
+        refresh_quiz_schedule()
+        quizzes = quiz_schedule.active_at(at)
+        body = app.json.dumps(quizzes)
+
+    if stream:
+        response = stream_quizzes(quizzes)
+    else:
+        response = Response(body, mimetype="application/json")
+
+    response.set_etag(etag)
+    return response
 
 
 # 3. GET /quizzes/<id>/result - to retrieve the result of a quiz by its ObjectId   -- limit of 10 per minute
 # It return the right option of the particular Quiz if its alocated time and additional 5 minutes has past -- right_answer 
+# Released results never change -- they are kept in memory and sent as immutable
+# Unknown ids and results not released yet are remembered too, so repeated calls skip MongoDb
 @app.route("/quizzes/<string:quiz_id>/result", methods=["GET"])
 @limiter.limit("10 per minute")
 def get_quiz_result(quiz_id):
     try:
-        quiz = quizzes_collection.find_one({"_id": ObjectId(quiz_id)})
-
-        if not quiz:
-            abort(404, "Quiz result not found")
+        quiz_object_id = ObjectId(quiz_id)
+    except InvalidId:
+        abort(400, "Invalid quiz ID")
 
-        now = datetime.now()
-        result_available_time = quiz["end_date"] + timedelta(minutes=5)
+    quiz_id = str(quiz_object_id)
 
-        if now < result_available_time:
-            abort(403, "Result not available yet! Try after the quiz has ended.")
+    state = cached_result_state(quiz_id)
+    if state is None:
+        quiz = quizzes_collection.find_one({"_id": quiz_object_id})
+        state = store_result_state(quiz_id, quiz, datetime.now())
 
-        return jsonify(
-            {
-                "id": str(quiz["_id"]),
-                "question": quiz["question"],
-                "options": quiz["options"],
-                "result": quiz["right_answer"]
-            }
-        )
+    status, body = state
+    abort_refused_result(status)
 
-    except InvalidId:
-        abort(400, "Invalid quiz ID")
+    return released_result_response(body)
 
 
 # 4. GET /quizzes/all - to retrieve all quizzes   -- limit of 10 per minute
-# It return the data of all Quizzes  -- id, question, options
+# It return one page of Quizzes  -- id, question, options -- ordered by id
+# Pagination is keyset based: ?after=<id of last quiz seen>&limit=N
+# The body is a JSON array, as it always was -- the Link header (rel="next") holds the URL of
+# the following page, there is none on the last page
+# In streaming mode the quizzes after the cursor are sent as NDJSON, no page size cap
+# An If-None-Match with the current ETag is answered with 304, without reading the quizzes
 @app.route("/quizzes/all", methods=["GET"])
 @limiter.limit("10 per minute")
 def get_all_quizzes():
-    all_quizzes = quizzes_collection.find({}, {"_id": 1, "question": 1, "options": 1})
+    try:
+        query, limit = parse_page_args(request.args)
+    except ValueError as error:
+        abort(400, str(error))
+
+    stream = wants_stream(request)
+    etag = listing_etag("all", get_quizzes_version(), stream)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    if stream:
+        all_quizzes = quiz_summaries_collection.find(query, QUIZ_SUMMARY_FIELDS).sort("_id", 1)
+
+        if request.args.get("limit"):
+            all_quizzes = all_quizzes.limit(limit)
+
+        response = stream_quizzes(quiz_summary(quiz) for quiz in all_quizzes)
+        response.set_etag(etag)
+        return response
+
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    # One extra document is fetched to know whether another page exists
+    page = (
+        quiz_summaries_collection.find(query, QUIZ_SUMMARY_FIELDS)
+        .sort("_id", 1)
+        .limit(limit + 1)
+    )
+
+    quizzes, next_link = quiz_page([quiz_summary(quiz) for quiz in page], limit)
+    response = jsonify(quizzes)
+    if next_link:
+        response.headers["Link"] = next_link
+    response.set_etag(etag)
+    return response
+
+
+# CLI command to verify the indexes -- flask --app app indexes [--rebuild]
+@app.cli.command("indexes")
+@click.option("--rebuild", is_flag=True, help="Drop and create the indexes again.")
+def indexes_command(rebuild):
+    if rebuild:
+        for collection, indexes in COLLECTION_INDEXES:
+            existing = {index["name"] for index in collection.list_indexes()}
+            for index in indexes:
+                if index.document["name"] in existing:
+                    collection.drop_index(index.document["name"])
+
+    existing = {index["name"] for index in quizzes_collection.list_indexes()}
+    for name in UNUSED_QUIZ_INDEXES:
+        if name in existing:
+            click.echo("Dropping unused index " + name)
+            quizzes_collection.drop_index(name)
+
+    missing = missing_indexes()
+    for collection, name, stale in missing:
+        if stale:
+            click.echo("Dropping index %s, its keys changed" % name)
+            collection.drop_index(name)
+
+    if missing:
+        click.echo("Creating missing indexes: " + ", ".join(name for _, name, _ in missing))
+        create_indexes()
+
+    for _, indexes in COLLECTION_INDEXES:
+        for index in indexes:
+            click.echo("ok " + index.document["name"])
+
+    result = backfill_options_text()
+    click.echo("options_text set on %d quizzes" % result.modified_count)
+
+
+# 5. POST /quizzes/bulk - to create many quizzes at once  -- limit of 10 per minute
+# Body is a JSON array or NDJSON (one quiz per line), each quiz follows the rules of POST /quizzes
+# It return the ID or the error of every item, in the order they were sent
+@app.route("/quizzes/bulk", methods=["POST"])
+@limiter.limit("10 per minute")
+def create_quizzes_bulk():
+    if request.mimetype == "application/json":
+        items = request.get_json(silent=True)
+
+        if not isinstance(items, list):
+            abort(400, "Invalid request body. JSON array expected.")
+
+    elif request.mimetype == "application/x-ndjson":
+        items = read_ndjson_items(request.stream)
+
+    else:
+        abort(400, "Unsupported Media Type or empty body")
+
+    results = []
+    boundaries = []
+    stored = True
+
+    # Once a chunk fails, the quizzes after it are not sent -- the client retries those only
+    for chunk in bulk_quiz_chunks(items, datetime.now(), results):
+        if stored:
+            stored = insert_quiz_chunk(chunk, boundaries)
+        else:
+            fail_quiz_chunk(chunk, BULK_NOT_ATTEMPTED_ERROR)
+
+    if boundaries:
+        invalidate_active_quiz_cache()
+        try:
+            bump_quizzes_version()
+        except PyMongoError as error:
+            app.logger.warning("Could not bump the quizzes version: %s", error)
+        add_quiz_boundaries(boundaries)
+
+    body, status_code = bulk_summary(results)
+    return jsonify(body), status_code
+
+
+# Yields the valid quizzes of a bulk request in chunks of (result, quiz) to insert
+# The result of every item is added to results, an error for the items that are not valid
+def bulk_quiz_chunks(items, now, results):
+    chunk = []
+
+    for index, item in enumerate(items):
+        if index >= MAX_BULK_QUIZZES:
+            results.append({"index": index, "error": "Too many quizzes in one request"})
+            continue
+
+        try:
+            if isinstance(item, ValueError):
+                raise item
+            quiz = build_quiz(item, now)
+        except ValueError as error:
+            results.append({"index": index, "error": str(error)})
+            continue
+
+        result = {"index": index}
+        results.append(result)
+        chunk.append((result, quiz))
+
+        if len(chunk) == BULK_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+# Body and status of a bulk answer -- 201 when every quiz is stored, 207 when some are, else 400
+def bulk_summary(results):
+    inserted = sum(1 for result in results if "id" in result)
+    if inserted == len(results):
+        status_code = 201
+    elif inserted == 0:
+        status_code = 400
+    else:
+        status_code = 207
+
+    return {"inserted": inserted, "results": results}, status_code
+
+
+# Yields the items of an NDJSON body -- a line that is not valid JSON gives a ValueError
+def read_ndjson_items(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            yield app.json.loads(line)
+        except ValueError:
+            yield ValueError("Invalid JSON line")
+
+
+# Stores a chunk of quizzes with one unordered insert_many
+# The result of each item gets its id, or the error of its write
+# It returns False when the whole chunk failed (e.g. MongoDb unreachable)
+def insert_quiz_chunk(chunk, boundaries):
+    write_errors = {}
+
+    try:
+        quizzes_collection.insert_many([quiz.__dict__ for _, quiz in chunk], ordered=False)
+    except BulkWriteError as error:
+        write_errors = bulk_write_errors(error)
+    except PyMongoError as error:
+        app.logger.warning("Could not store a chunk of quizzes: %s", error)
+        fail_quiz_chunk(chunk, BULK_FAILED_ERROR)
+        return False
+
+    finish_quiz_chunk(chunk, write_errors, boundaries)
+    return True
+
 
+# Errors of the quizzes of a chunk that failed, and of the chunks after it
+BULK_FAILED_ERROR = "Could not store the quiz, or its write was not confirmed."
+BULK_NOT_ATTEMPTED_ERROR = "Not stored, an earlier chunk failed. Try again later."
+
+
+# Sets the same error on every result of a chunk
+def fail_quiz_chunk(chunk, message):
+    for result, _ in chunk:
+        result["error"] = message
+
+
+# Errors of an unordered insert_many, by index of the document
+def bulk_write_errors(error):
+    return {
+        write_error["index"]: write_error["errmsg"]
+        for write_error in error.details.get("writeErrors", [])
+    }
+
+
+# Sets the id or the write error of every result of an inserted chunk
+# The quizzes stored are added to the schedule and their dates to boundaries
+def finish_quiz_chunk(chunk, write_errors, boundaries):
+    inserted = []
+    for index, (result, quiz) in enumerate(chunk):
+        if index in write_errors:
+            result["error"] = write_errors[index]
+        else:
+            result["id"] = quiz.__dict__["_id"]
+            boundaries.extend([quiz.start_date, quiz.end_date])
+            inserted.append(quiz.__dict__)
+
+    quiz_schedule.add(inserted)
+
+
+# 6. GET /status/pool - connection pool statistics of this worker
+@app.route("/status/pool", methods=["GET"])
+@limiter.limit("10 per minute")
+def get_pool_status():
+    return jsonify(pool_stats.snapshot())
+
+
+# 7. GET /status/cache - statistics of the result caches of this worker
+@app.route("/status/cache", methods=["GET"])
+@limiter.limit("10 per minute")
+def get_cache_status():
     return jsonify(
-        [
-            {
-                "id": str(quiz["_id"]),
-                "question": quiz["question"],
-                "options": quiz["options"],
-            }
-            for quiz in all_quizzes
-        ]
+        {"results": result_cache.stats(), "refusals": negative_result_cache.stats()}
     )
 
 
-# 5. Error handling
+# ObjectId of an id of POST /quizzes/results -- None when it is not a valid id string
+# (ObjectId(None) would make a new id)
+def result_quiz_id(quiz_id):
+    if not isinstance(quiz_id, str):
+        return None
+    try:
+        return ObjectId(quiz_id)
+    except InvalidId:
+        return None
+
+
+# 8. POST /quizzes/results - to retrieve the results of many quizzes at once  -- limit of 10 per minute
+# Body is a JSON array of quiz ids, all the quizzes that are not cached are read with one query
+# It return the state of every id, in the order they were sent -- released (with the result),
+# not_released, not_found or invalid_id -- with the same release rule as GET /quizzes/<id>/result
+@app.route("/quizzes/results", methods=["POST"])
+@limiter.limit("10 per minute")
+def get_quiz_results():
+    quiz_ids = request.get_json(silent=True)
+
+    if not isinstance(quiz_ids, list):
+        abort(400, "Invalid request body. JSON array of quiz ids expected.")
+
+    if len(quiz_ids) > MAX_BATCH_RESULTS:
+        abort(400, "Too many quiz ids in one request")
+
+    states, object_ids = cached_result_states(quiz_ids)
+
+    if object_ids:
+        found = {
+            str(quiz["_id"]): quiz
+            for quiz in quizzes_collection.find({"_id": {"$in": list(object_ids.values())}})
+        }
+        store_result_states(states, object_ids, found)
+
+    return jsonify({"results": batch_results(quiz_ids, states)})
+
+
+# States of the cached results of a batch, by id -- with the ObjectIds of the others to read
+def cached_result_states(quiz_ids):
+    states = {}
+    object_ids = {}
+    for quiz_id in quiz_ids:
+        quiz_object_id = result_quiz_id(quiz_id)
+        if quiz_object_id is None:
+            continue
+
+        key = str(quiz_object_id)
+        if key not in states:
+            states[key] = cached_result_state(key)
+            if states[key] is None:
+                object_ids[key] = quiz_object_id
+
+    return states, object_ids
+
+
+# Adds the states of the quizzes read for a batch (found by id) to states
+def store_result_states(states, object_ids, found):
+    now = datetime.now()
+    for key in object_ids:
+        states[key] = store_result_state(key, found.get(key), now)
+
+
+# Result of every id of a batch, in the order they were sent
+def batch_results(quiz_ids, states):
+    results = []
+    for quiz_id in quiz_ids:
+        quiz_object_id = result_quiz_id(quiz_id)
+        state = states.get(str(quiz_object_id)) if quiz_object_id is not None else None
+
+        if state is None:
+            results.append({"id": quiz_id, "status": "invalid_id"})
+        elif state[0] == "missing":
+            results.append({"id": quiz_id, "status": "not_found"})
+        elif state[0] == "release_at":
+            results.append({"id": quiz_id, "status": "not_released"})
+        else:
+            results.append({**app.json.loads(state[1]), "status": "released"})
+
+    return results
+
+
+# 9. GET /status/requests - timings of the requests of this worker, by route
+@app.route("/status/requests", methods=["GET"])
+@limiter.limit("10 per minute")
+def get_request_status():
+    return jsonify(request_timings_snapshot())
+
+
+# 10. GET /metrics - Prometheus metrics of all the workers
+# Not rate limited -- Prometheus scrapes it every few seconds from the same address
+@app.route("/metrics", methods=["GET"])
+@limiter.exempt
+def get_metrics():
+    return Response(metrics_text(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# 11. POST /quizzes/<id>/answers - to submit the answer of a participant  -- limit of 10 per minute
+# Body is {"participant": <id>, "answer": <index of the option>}, accepted while the quiz is active
+# Answers are written in batches -- it return 202 once the answer is queued
+# Only the first answer of each participant is kept
+@app.route("/quizzes/<string:quiz_id>/answers", methods=["POST"])
+@limiter.limit("10 per minute")
+def submit_answer(quiz_id):
+    try:
+        quiz_object_id = ObjectId(quiz_id)
+    except InvalidId:
+        abort(400, "Invalid quiz ID")
+
+    entry = find_scheduled_quiz(quiz_object_id)
+    answer = build_answer(quiz_object_id, entry, request.get_json(silent=True), datetime.now())
+
+    if not answer_buffer.put(answer):
+        abort(503, "Too many answers waiting to be written. Try again later.")
+
+    return jsonify({"status": "queued"}), 202
+
+
+# 12. GET /quizzes/<id>/tally - answers given to each option of a quiz  -- limit of 10 per minute
+# Counts of all the workers as written to MongoDb, plus the ones of this worker not written yet
+@app.route("/quizzes/<string:quiz_id>/tally", methods=["GET"])
+@limiter.limit("10 per minute")
+def get_quiz_tally(quiz_id):
+    try:
+        quiz_object_id = ObjectId(quiz_id)
+    except InvalidId:
+        abort(400, "Invalid quiz ID")
+
+    entry = find_scheduled_quiz(quiz_object_id)
+    if entry is None:
+        abort(404, "Quiz not found")
+
+    stored = tally_cache.get(quiz_object_id)
+    if stored is None:
+        flushes = tally_counter.flushes
+        stored = tallies_collection.find_one({"_id": quiz_object_id}) or {}
+        cache_stored_tally(
+            quiz_object_id,
+            stored,
+            flushes,
+            datetime.now() + timedelta(seconds=TALLY_FLUSH_SECONDS),
+        )
+
+    return jsonify(quiz_tally(quiz_object_id, entry[2], stored))
+
+
+# Error handling
 @app.errorhandler(400)
+@app.errorhandler(403)
 @app.errorhandler(404)
+@app.errorhandler(429)
+@app.errorhandler(503)
 def handle_error(error):
     response = jsonify({"error": str(error)})
     response.status_code = error.code
@@ -0,0 +1,672 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from functools import wraps
+from quart import Quart, jsonify, request, websocket, abort, render_template, Response, g
+from quart.json.provider import DefaultJSONProvider
+from pymongo import AsyncMongoClient, ReturnDocument
+from pymongo.errors import BulkWriteError, PyMongoError
+from bson.objectid import ObjectId
+from bson.objectid import InvalidId
+from limits import parse
+from limits.errors import ConfigurationError
+from limits.storage import storage_from_string
+from limits.aio.strategies import MovingWindowRateLimiter
+
+# The quiz rules, the active quiz cache and the status scheduler are shared with the WSGI app
+from app import (
+    BULK_FAILED_ERROR,
+    BULK_NOT_ATTEMPTED_ERROR,
+    MAX_BATCH_RESULTS,
+    MAX_PAGE_SIZE,
+    MONGO_CLIENT_OPTIONS,
+    QUIZZES_VERSION_ID,
+    QUIZ_EVENTS_KEEPALIVE_SECONDS,
+    QUIZ_EVENTS_QUEUE_SIZE,
+    QUIZ_SCHEDULE_FIELDS,
+    QUIZ_SUMMARY_FIELDS,
+    RATELIMIT_STORAGE_URI,
+    RAW_DOCUMENT_OPTIONS,
+    TALLY_FLUSH_SECONDS,
+    TALLY_LIVE_BUFFER,
+    TALLY_LIVE_TICK_MS,
+    EventSubscriber,
+    FastJSONMixin,
+    abort_refused_result,
+    add_quiz_boundaries,
+    answer_buffer,
+    batch_results,
+    build_answer,
+    build_quiz,
+    bulk_quiz_chunks,
+    bulk_summary,
+    bulk_write_errors,
+    cache_stored_tally,
+    cached_result_state,
+    cached_result_states,
+    command_timer,
+    fail_quiz_chunk,
+    count_rate_limited,
+    finish_quiz_chunk,
+    finish_request_timing,
+    invalidate_active_quiz_cache,
+    listing_etag,
+    metrics_text,
+    negative_result_cache,
+    parse_at_arg,
+    parse_page_args,
+    pool_stats,
+    quiz_events,
+    quiz_page,
+    quiz_schedule,
+    quiz_summary,
+    quiz_tally,
+    read_active_quiz_cache,
+    read_ndjson_items,
+    read_quizzes_version_cache,
+    refresh_quiz_schedule as load_quiz_schedule,
+    released_result_response,
+    request_timings_snapshot,
+    result_cache,
+    sse_message,
+    start_request_timing,
+    store_active_quiz_cache,
+    store_quizzes_version,
+    store_result_state,
+    store_result_states,
+    tally_cache,
+    tally_counter,
+    wants_stream,
+)
+
+
+# JSON encoding of the app -- same fast encoder as the WSGI app
+class QuizJSONProvider(FastJSONMixin, DefaultJSONProvider):
+    pass
+
+
+# ASGI variant of the app -- same routes, served by Quart with the async PyMongo client
+# A single process can hold many slow connections as no worker waits on MongoDb
+# Run with: uvicorn --factory asgi:create_app
+def create_app():
+    app = Quart(__name__)
+    app.json_provider_class = QuizJSONProvider
+    app.json = QuizJSONProvider(app)
+
+    # MongoDb configuration
+    mongo_client = AsyncMongoClient(
+        os.environ.get("MONGODB_CONNECTION_URL"),
+        event_listeners=[pool_stats, command_timer],
+        **MONGO_CLIENT_OPTIONS,
+    )
+    db = mongo_client["timed_quiz"]
+    quizzes_collection = db["quizzes"]
+    meta_collection = db["meta"]
+    tallies_collection = db["tallies"]
+    quiz_summaries_collection = quizzes_collection.with_options(
+        codec_options=RAW_DOCUMENT_OPTIONS
+    )
+
+    # Limiter to limit the requests from a single IP address -- same limits as the WSGI app
+    # The counters live in the same storage as the WSGI app, with its async driver
+    try:
+        rate_limit_storage = storage_from_string("async+" + RATELIMIT_STORAGE_URI)
+    except ConfigurationError as error:
+        raise RuntimeError(
+            "RATELIMIT_STORAGE_URI %s cannot be used by the ASGI app: %s"
+            % (RATELIMIT_STORAGE_URI, error)
+        ) from error
+    rate_limiter = MovingWindowRateLimiter(rate_limit_storage)
+    default_limit = parse("1000 per day")
+    live_limit = parse("10 per minute")
+
+    def rate_limit(value):
+        route_limit = parse(value)
+
+        def decorator(view):
+            @wraps(view)
+            async def limited_view(*args, **kwargs):
+                if not await rate_limiter.hit(
+                    route_limit, view.__name__, request.remote_addr
+                ):
+                    abort(429, value)
+                return await view(*args, **kwargs)
+
+            return limited_view
+
+        return decorator
+
+    # Streams the quizzes as NDJSON -- one quiz per line, nothing is buffered
+    def stream_quizzes(quizzes):
+        async def generate():
+            async for quiz in quizzes:
+                yield app.json.dumps(quiz) + "\n"
+
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    # Public view of each quiz of an async cursor
+    async def summaries(cursor):
+        async for quiz in cursor:
+            yield quiz_summary(quiz)
+
+    # Quizzes from the active quiz cache, as an async iterable
+    async def cached_summaries(quizzes):
+        for quiz in quizzes:
+            yield quiz
+
+    # Empty 304 answer for a client that already has the current listing
+    def not_modified(etag):
+        response = Response("", status=304)
+        response.set_etag(etag)
+        return response
+
+    # Version of the quizzes, shared with the WSGI app -- see get_quizzes_version
+    async def get_quizzes_version():
+        version = read_quizzes_version_cache()
+        if version is None:
+            document = await meta_collection.find_one({"_id": QUIZZES_VERSION_ID})
+            version = document["version"] if document else 0
+            store_quizzes_version(version)
+        return version
+
+    async def bump_quizzes_version():
+        document = await meta_collection.find_one_and_update(
+            {"_id": QUIZZES_VERSION_ID},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        store_quizzes_version(document["version"])
+
+    # Reads the quizzes created since the last load -- see refresh_quiz_schedule
+    # The load runs in a thread under the schedule lock: concurrent requests wait for a
+    # single read, and the trees are not built on the event loop
+    async def refresh_quiz_schedule():
+        version = await get_quizzes_version()
+        if not quiz_schedule.is_current(version):
+            await asyncio.to_thread(load_quiz_schedule)
+
+    # Schedule entry of a quiz -- see find_scheduled_quiz
+    async def find_scheduled_quiz(quiz_object_id):
+        entry = quiz_schedule.get(quiz_object_id)
+        if entry is None:
+            quiz = await quizzes_collection.find_one({"_id": quiz_object_id}, QUIZ_SCHEDULE_FIELDS)
+            if quiz:
+                await asyncio.to_thread(quiz_schedule.add, [quiz])
+                entry = quiz_schedule.get(quiz_object_id)
+        return entry
+
+    # Stored tallies of the given quizzes -- from the tally cache, the others with one query
+    async def read_stored_tallies(quiz_ids):
+        stored = {}
+        missing = []
+        for quiz_id in quiz_ids:
+            cached = tally_cache.get(quiz_id)
+            if cached is None:
+                missing.append(quiz_id)
+            else:
+                stored[quiz_id] = cached
+
+        if missing:
+            flushes = tally_counter.flushes
+            found = {
+                tally["_id"]: tally
+                async for tally in tallies_collection.find({"_id": {"$in": missing}})
+            }
+            expires_at = datetime.now() + timedelta(seconds=TALLY_FLUSH_SECONDS)
+            for quiz_id in missing:
+                stored[quiz_id] = found.get(quiz_id, {})
+                cache_stored_tally(quiz_id, stored[quiz_id], flushes, expires_at)
+
+        return stored
+
+    # Viewers of the live tallies -- the send queues of the connections, by quiz id
+    # tally_sent has the counts the viewers of each quiz last got
+    tally_viewers = {}
+    tally_sent = {}
+    tally_broadcast = {"task": None}
+
+    # Sends the change of the tally of every watched quiz, once per tick -- all the answers
+    # of a tick are a single message. It stops when nobody is watching
+    async def broadcast_tallies():
+        while tally_viewers:
+            await asyncio.sleep(TALLY_LIVE_TICK_MS / 1000)
+
+            try:
+                stored = await read_stored_tallies(list(tally_viewers))
+            except PyMongoError:
+                continue
+
+            for quiz_id, viewers in list(tally_viewers.items()):
+                summary = quiz_schedule.get(quiz_id)[2]
+                counts = quiz_tally(quiz_id, summary, stored[quiz_id])["counts"]
+                previous = tally_sent.get(quiz_id, [0] * len(counts))
+                if counts == previous:
+                    continue
+
+                tally_sent[quiz_id] = counts
+                message = app.json.dumps(
+                    {
+                        "id": quiz_id,
+                        "delta": [count - sent for count, sent in zip(counts, previous)],
+                        "total": sum(counts),
+                    }
+                )
+
+                for viewer in list(viewers):
+                    try:
+                        viewer.put_nowait(message)
+                    except asyncio.QueueFull:
+                        # A viewer that does not keep up is disconnected
+                        viewers.discard(viewer)
+                        while not viewer.empty():
+                            viewer.get_nowait()
+                        viewer.put_nowait(None)
+
+    # Timing of each request -- same Server-Timing header and histograms as the WSGI app
+    @app.before_request
+    async def start_timer():
+        g.request_started = start_request_timing()
+
+    @app.after_request
+    async def stop_timer(response):
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        count_rate_limited(route, response)
+
+        if "request_started" in g:
+            finish_request_timing(route, g.request_started, response)
+        return response
+
+    # Api home page -- documentation
+    @app.route("/")
+    async def home():
+        if not await rate_limiter.hit(default_limit, "home", request.remote_addr):
+            abort(429, "1000 per day")
+        return await render_template("index.html")
+
+    # 1. POST /quizzes - to create a new quiz
+    @app.route("/quizzes", methods=["POST"])
+    @rate_limit("10 per minute")
+    async def create_quiz():
+        if request.headers["Content-Type"] == "application/json":  # JSON data
+            data = await request.get_json()
+
+            if data is None:
+                abort(400, "Invalid request body. JSON data expected.")
+
+        elif (
+            request.headers["Content-Type"] == "application/x-www-form-urlencoded"
+        ):  # Form data
+            data = await request.form
+
+        else:
+            abort(400, "Unsupported Media Type or empty body")
+
+        try:
+            quiz = build_quiz(data, datetime.now())
+        except ValueError as error:
+            abort(400, str(error))
+
+        # Store the Quiz in the MongoDb database
+        result = await quizzes_collection.insert_one(quiz.__dict__)
+        quiz.id = str(result.inserted_id)
+        await asyncio.to_thread(quiz_schedule.add, [quiz.__dict__])
+        invalidate_active_quiz_cache()
+        await bump_quizzes_version()
+        add_quiz_boundaries([quiz.start_date, quiz.end_date])
+
+        return jsonify({"id": quiz.id}), 201
+
+    # 2. GET /quizzes/active - to retrieve the active quiz
+    @app.route("/quizzes/active", methods=["GET"])
+    @rate_limit("10 per minute")
+    async def get_active_quiz():
+        try:
+            at = parse_at_arg(request.args)
+        except ValueError as error:
+            abort(400, str(error))
+
+        stream = wants_stream(request)
+        listing = "active" if at is None else "active@" + at.isoformat()
+        etag = listing_etag(listing, await get_quizzes_version(), stream)
+        if request.if_none_match.contains(etag):
+            return not_modified(etag)
+
+        if at is None:
+            now = datetime.now()
+
+            quizzes, body, generation = read_active_quiz_cache(now)
+            if body is None:
+                await refresh_quiz_schedule()
+                quizzes = quiz_schedule.active_at(now)
+                body = app.json.dumps(quizzes)
+
+                boundary = quiz_schedule.next_boundary(now)
+                store_active_quiz_cache(generation, quizzes, body, now, boundary)
+        else:
+            await refresh_quiz_schedule()
+            quizzes = quiz_schedule.active_at(at)
+            body = app.json.dumps(quizzes)
+
+        if stream:
+            response = stream_quizzes(cached_summaries(quizzes))
+        else:
+            response = Response(body, mimetype="application/json")
+
+        response.set_etag(etag)
+        return response
+
+    # 3. GET /quizzes/<id>/result - to retrieve the result of a quiz by its ObjectId
+    @app.route("/quizzes/<string:quiz_id>/result", methods=["GET"])
+    @rate_limit("10 per minute")
+    async def get_quiz_result(quiz_id):
+        try:
+            quiz_object_id = ObjectId(quiz_id)
+        except InvalidId:
+            abort(400, "Invalid quiz ID")
+
+        quiz_id = str(quiz_object_id)
+
+        state = cached_result_state(quiz_id)
+        if state is None:
+            quiz = await quizzes_collection.find_one({"_id": quiz_object_id})
+            state = store_result_state(quiz_id, quiz, datetime.now())
+
+        status, body = state
+        abort_refused_result(status)
+
+        return released_result_response(body, Response)
+
+    # 4. GET /quizzes/all - to retrieve all quizzes, one page at a time
+    @app.route("/quizzes/all", methods=["GET"])
+    @rate_limit("10 per minute")
+    async def get_all_quizzes():
+        try:
+            query, limit = parse_page_args(request.args)
+        except ValueError as error:
+            abort(400, str(error))
+
+        stream = wants_stream(request)
+        etag = listing_etag("all", await get_quizzes_version(), stream)
+        if request.if_none_match.contains(etag):
+            return not_modified(etag)
+
+        if stream:
+            all_quizzes = quiz_summaries_collection.find(query, QUIZ_SUMMARY_FIELDS).sort("_id", 1)
+
+            if request.args.get("limit"):
+                all_quizzes = all_quizzes.limit(limit)
+
+            response = stream_quizzes(summaries(all_quizzes))
+            response.set_etag(etag)
+            return response
+
+        limit = min(limit, MAX_PAGE_SIZE)
+
+        # One extra document is fetched to know whether another page exists
+        page = (
+            quiz_summaries_collection.find(query, QUIZ_SUMMARY_FIELDS)
+            .sort("_id", 1)
+            .limit(limit + 1)
+        )
+
+        quizzes, next_link = quiz_page([quiz async for quiz in summaries(page)], limit)
+        response = jsonify(quizzes)
+        if next_link:
+            response.headers["Link"] = next_link
+        response.set_etag(etag)
+        return response
+
+    # 5. POST /quizzes/bulk - to create many quizzes at once
+    # Same rules and answer as the WSGI app -- a JSON array or NDJSON, one insert per chunk
+    @app.route("/quizzes/bulk", methods=["POST"])
+    @rate_limit("10 per minute")
+    async def create_quizzes_bulk():
+        if request.mimetype == "application/json":
+            items = await request.get_json(silent=True)
+
+            if not isinstance(items, list):
+                abort(400, "Invalid request body. JSON array expected.")
+
+        elif request.mimetype == "application/x-ndjson":
+            items = read_ndjson_items((await request.get_data(as_text=True)).splitlines())
+
+        else:
+            abort(400, "Unsupported Media Type or empty body")
+
+        results = []
+        boundaries = []
+        stored = True
+
+        # Once a chunk fails, the quizzes after it are not sent -- see the WSGI app
+        for chunk in bulk_quiz_chunks(items, datetime.now(), results):
+            if not stored:
+                fail_quiz_chunk(chunk, BULK_NOT_ATTEMPTED_ERROR)
+                continue
+
+            write_errors = {}
+            try:
+                await quizzes_collection.insert_many(
+                    [quiz.__dict__ for _, quiz in chunk], ordered=False
+                )
+            except BulkWriteError as error:
+                write_errors = bulk_write_errors(error)
+            except PyMongoError as error:
+                app.logger.warning("Could not store a chunk of quizzes: %s", error)
+                fail_quiz_chunk(chunk, BULK_FAILED_ERROR)
+                stored = False
+                continue
+
+            await asyncio.to_thread(finish_quiz_chunk, chunk, write_errors, boundaries)
+
+        if boundaries:
+            invalidate_active_quiz_cache()
+            try:
+                await bump_quizzes_version()
+            except PyMongoError as error:
+                app.logger.warning("Could not bump the quizzes version: %s", error)
+            add_quiz_boundaries(boundaries)
+
+        body, status_code = bulk_summary(results)
+        return jsonify(body), status_code
+
+    # 6. GET /status/pool - connection pool statistics of this worker
+    @app.route("/status/pool", methods=["GET"])
+    @rate_limit("10 per minute")
+    async def get_pool_status():
+        return jsonify(pool_stats.snapshot())
+
+    # 7. GET /status/cache - statistics of the result caches of this worker
+    @app.route("/status/cache", methods=["GET"])
+    @rate_limit("10 per minute")
+    async def get_cache_status():
+        return jsonify(
+            {"results": result_cache.stats(), "refusals": negative_result_cache.stats()}
+        )
+
+    # 8. POST /quizzes/results - to retrieve the results of many quizzes at once
+    # Same answer as the WSGI app -- the quizzes that are not cached are read with one query
+    @app.route("/quizzes/results", methods=["POST"])
+    @rate_limit("10 per minute")
+    async def get_quiz_results():
+        quiz_ids = await request.get_json(silent=True)
+
+        if not isinstance(quiz_ids, list):
+            abort(400, "Invalid request body. JSON array of quiz ids expected.")
+
+        if len(quiz_ids) > MAX_BATCH_RESULTS:
+            abort(400, "Too many quiz ids in one request")
+
+        states, object_ids = cached_result_states(quiz_ids)
+
+        if object_ids:
+            found = {
+                str(quiz["_id"]): quiz
+                async for quiz in quizzes_collection.find(
+                    {"_id": {"$in": list(object_ids.values())}}
+                )
+            }
+            store_result_states(states, object_ids, found)
+
+        return jsonify({"results": batch_results(quiz_ids, states)})
+
+    # 9. GET /status/requests - timings of the requests of this worker, by route
+    @app.route("/status/requests", methods=["GET"])
+    @rate_limit("10 per minute")
+    async def get_request_status():
+        return jsonify(request_timings_snapshot())
+
+    # 10. GET /metrics - Prometheus metrics of all the workers -- not rate limited
+    @app.route("/metrics", methods=["GET"])
+    async def get_metrics():
+        return Response(metrics_text(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+    # 11. POST /quizzes/<id>/answers - to submit the answer of a participant
+    # Queued for the same writer thread as the WSGI app, nothing waits on MongoDb here
+    @app.route("/quizzes/<string:quiz_id>/answers", methods=["POST"])
+    @rate_limit("10 per minute")
+    async def submit_answer(quiz_id):
+        try:
+            quiz_object_id = ObjectId(quiz_id)
+        except InvalidId:
+            abort(400, "Invalid quiz ID")
+
+        entry = await find_scheduled_quiz(quiz_object_id)
+        data = await request.get_json(silent=True)
+        answer = build_answer(quiz_object_id, entry, data, datetime.now())
+
+        if not answer_buffer.put(answer):
+            abort(503, "Too many answers waiting to be written. Try again later.")
+
+        return jsonify({"status": "queued"}), 202
+
+    # 12. GET /quizzes/<id>/tally - answers given to each option of a quiz
+    @app.route("/quizzes/<string:quiz_id>/tally", methods=["GET"])
+    @rate_limit("10 per minute")
+    async def get_quiz_tally(quiz_id):
+        try:
+            quiz_object_id = ObjectId(quiz_id)
+        except InvalidId:
+            abort(400, "Invalid quiz ID")
+
+        entry = await find_scheduled_quiz(quiz_object_id)
+        if entry is None:
+            abort(404, "Quiz not found")
+
+        stored = tally_cache.get(quiz_object_id)
+        if stored is None:
+            flushes = tally_counter.flushes
+            stored = await tallies_collection.find_one({"_id": quiz_object_id}) or {}
+            cache_stored_tally(
+                quiz_object_id,
+                stored,
+                flushes,
+                datetime.now() + timedelta(seconds=TALLY_FLUSH_SECONDS),
+            )
+
+        return jsonify(quiz_tally(quiz_object_id, entry[2], stored))
+
+    # 13. GET /quizzes/events - Server-Sent Events stream of the quizzes
+    # Each client waits on the event loop -- the broadcaster thread wakes it up
+    @app.route("/quizzes/events", methods=["GET"])
+    @rate_limit("10 per minute")
+    async def get_quiz_events():
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+
+        def notify():
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                pass  # The event loop is closed
+
+        subscriber = EventSubscriber(QUIZ_EVENTS_QUEUE_SIZE, notify)
+        quiz_events.subscribe(subscriber)
+
+        async def generate():
+            try:
+                yield "retry: 5000\n\n"
+                while not subscriber.dropped:
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), QUIZ_EVENTS_KEEPALIVE_SECONDS)
+                    except asyncio.TimeoutError:
+                        yield ": keep-alive\n\n"
+                    wakeup.clear()
+
+                    for event in subscriber.pop():
+                        yield sse_message(event)
+            finally:
+                quiz_events.unsubscribe(subscriber)
+
+        response = Response(generate(), mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        response.timeout = None
+        return response
+
+    # 14. WebSocket /quizzes/<id>/tally/live - live answer counts of a quiz -- 10 per minute
+    # The first message has the counts ({"id", "options", "counts", "total"}), then every tick
+    # with new answers sends {"id", "delta": [new answers of each option], "total"}
+    # Each viewer has its own send buffer -- one that fills up is closed with 1013 (try again)
+    @app.websocket("/quizzes/<string:quiz_id>/tally/live")
+    async def live_quiz_tally(quiz_id):
+        if not await rate_limiter.hit(live_limit, "live_quiz_tally", websocket.remote_addr):
+            abort(429, "10 per minute")
+
+        try:
+            quiz_object_id = ObjectId(quiz_id)
+        except InvalidId:
+            abort(400, "Invalid quiz ID")
+
+        entry = await find_scheduled_quiz(quiz_object_id)
+        if entry is None:
+            abort(404, "Quiz not found")
+
+        await websocket.accept()
+
+        counts = tally_sent.get(quiz_object_id)
+        if counts is None:
+            stored = await read_stored_tallies([quiz_object_id])
+            counts = quiz_tally(quiz_object_id, entry[2], stored[quiz_object_id])["counts"]
+            counts = tally_sent.setdefault(quiz_object_id, counts)
+
+        viewer = asyncio.Queue(maxsize=TALLY_LIVE_BUFFER)
+        snapshot = {
+            "id": quiz_object_id,
+            "options": entry[2]["options"],
+            "counts": counts,
+            "total": sum(counts),
+        }
+        viewer.put_nowait(app.json.dumps(snapshot))
+        tally_viewers.setdefault(quiz_object_id, set()).add(viewer)
+
+        if tally_broadcast["task"] is None or tally_broadcast["task"].done():
+            tally_broadcast["task"] = asyncio.create_task(broadcast_tallies())
+
+        try:
+            while True:
+                message = await viewer.get()
+                if message is None:
+                    await websocket.close(1013, "Too slow to receive the tally")
+                    return
+                await websocket.send(message)
+        finally:
+            viewers = tally_viewers.get(quiz_object_id)
+            if viewers is not None:
+                viewers.discard(viewer)
+                if not viewers:
+                    del tally_viewers[quiz_object_id]
+                    tally_sent.pop(quiz_object_id, None)
+
+    # Error handling
+    @app.errorhandler(400)
+    @app.errorhandler(403)
+    @app.errorhandler(404)
+    @app.errorhandler(429)
+    @app.errorhandler(503)
+    async def handle_error(error):
+        response = jsonify({"error": str(error)})
+        response.status_code = error.code
+        return response
+
+    return app
@@ -0,0 +1 @@
+# Benchmarks of the QuizAPI endpoints -- run with: python -m benchmarks --help
@@ -0,0 +1,312 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+
+# Loads the app against the MongoDb to benchmark
+# Without a URL, pymongo is patched with mongomock before the app is imported
+def load_app(mongo_url):
+    if mongo_url:
+        os.environ["MONGODB_CONNECTION_URL"] = mongo_url
+    else:
+        import mongomock
+
+        os.environ["MONGODB_CONNECTION_URL"] = "mongodb://localhost"
+        mongomock.patch(servers=(("localhost", 27017),)).start()
+
+    import app as quiz_app
+
+    # Every request of the benchmark comes from the same address
+    quiz_app.limiter.enabled = False
+
+    # The status jobs only run in the scheduler leader -- seed() syncs the status right away
+    quiz_app.leader_lease.acquire()
+
+    if not mongo_url:
+        # mongomock cannot decode documents as RawBSONDocument
+        quiz_app.quiz_summaries_collection = quiz_app.quizzes_collection
+
+    return quiz_app
+
+
+# Stores count quizzes -- active_fraction of them are active, the rest are split
+# between released and upcoming quizzes. It returns the ids of the released ones
+def seed(quiz_app, count, active_fraction, batch_size=1000):
+    now = datetime.now()
+    released_ids = []
+    batch = []
+
+    for index in range(count):
+        if index < count * active_fraction:
+            start_date, end_date = now - timedelta(hours=1), now + timedelta(days=1)
+        elif index % 2:
+            start_date, end_date = now - timedelta(days=2), now - timedelta(days=1)
+        else:
+            start_date, end_date = now + timedelta(days=1), now + timedelta(days=2)
+
+        quiz = quiz_app.Quiz(
+            "Question %d" % index,
+            ["Option A", "Option B", "Option C", "Option D"],
+            random.randint(1, 4),
+            start_date,
+            end_date,
+        )
+        quiz.status = quiz_app.quiz_status_at(start_date, end_date, now)
+        batch.append(quiz.__dict__)
+
+        if len(batch) == batch_size or index == count - 1:
+            quiz_app.quizzes_collection.insert_many(batch)
+            released_ids.extend(
+                str(document["_id"]) for document in batch if document["end_date"] < now
+            )
+            batch = []
+
+    quiz_app.sync_quiz_status()
+    return released_ids
+
+
+# Requests of each endpoint -- a function of the request number giving
+# (method, path, body, headers)
+def scenarios(released_ids, page_cursors):
+    now = datetime.now()
+    new_quiz = json.dumps(
+        {
+            "question": "Benchmark question",
+            "options": "A, B, C, D",
+            "rightAnswer": 2,
+            "startDate": (now + timedelta(days=3)).isoformat(),
+            "endDate": (now + timedelta(days=4)).isoformat(),
+        }
+    )
+
+    def create_quiz(number):
+        return "POST", "/quizzes", new_quiz, {"Content-Type": "application/json"}
+
+    def get_active_quiz(number):
+        return "GET", "/quizzes/active", None, {}
+
+    def get_quiz_result(number):
+        return "GET", "/quizzes/%s/result" % random.choice(released_ids), None, {}
+
+    def get_all_quizzes(number):
+        after = random.choice(page_cursors)
+        path = "/quizzes/all?limit=100" + ("&after=" + after if after else "")
+        return "GET", path, None, {}
+
+    def get_all_quizzes_stream(number):
+        return "GET", "/quizzes/all?stream=1&limit=1000", None, {}
+
+    return {
+        "create_quiz": create_quiz,
+        "get_active_quiz": get_active_quiz,
+        "get_quiz_result": get_quiz_result,
+        "get_all_quizzes": get_all_quizzes,
+        "get_all_quizzes_stream": get_all_quizzes_stream,
+    }
+
+
+# Cursors of the first pages of GET /quizzes/all -- None is the first page
+def collect_page_cursors(client, pages=20):
+    cursors = [None]
+    while len(cursors) < pages:
+        path = "/quizzes/all?limit=100"
+        if cursors[-1]:
+            path += "&after=" + cursors[-1]
+        next_link = client.get(path).headers.get("Link")
+        if not next_link:
+            break
+        cursors.append(re.search(r"after=(\w+)", next_link).group(1))
+    return cursors
+
+
+# Peak resident memory of this process, in KB -- ru_maxrss only grows, so it is reported
+# once for the whole run, not per endpoint
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(endpoint, driver, latencies, errors, elapsed):
+    latencies.sort()
+    return {
+        "endpoint": endpoint,
+        "driver": driver,
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+    }
+
+
+# Runs the requests one after the other through the Flask test client
+def run_test_client(client, make_request, requests):
+    latencies = []
+    errors = 0
+
+    started = time.perf_counter()
+    for number in range(requests):
+        method, path, body, headers = make_request(number)
+
+        request_started = time.perf_counter()
+        response = client.open(path, method=method, data=body, headers=headers)
+        response.get_data()
+        latencies.append(time.perf_counter() - request_started)
+
+        if response.status_code >= 400:
+            errors += 1
+
+    return latencies, errors, time.perf_counter() - started
+
+
+# Request handler of the benchmark server -- the access log would cost more than some requests
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+# Runs the requests over HTTP against a WSGI server, concurrency at a time
+def run_wsgi(address, make_request, requests, concurrency):
+    host, port = address
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def send(number):
+        method, path, body, headers = make_request(number)
+
+        request_started = time.perf_counter()
+        connection = http.client.HTTPConnection(host, port)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            failed = response.status >= 400
+        except OSError:
+            failed = True
+        finally:
+            connection.close()
+        latency = time.perf_counter() - request_started
+
+        with lock:
+            latencies.append(latency)
+            if failed:
+                errors.append(number)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(requests)))
+
+    return latencies, len(errors), time.perf_counter() - started
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmark the QuizAPI endpoints and print the results as JSON.",
+    )
+    parser.add_argument(
+        "--mongo-url",
+        help="MongoDb to use (a local mongod, its timed_quiz database is filled). "
+        "mongomock is used when not given.",
+    )
+    parser.add_argument("--quizzes", type=int, default=10000, help="Quizzes to seed.")
+    parser.add_argument(
+        "--active-fraction", type=float, default=0.01, help="Part of the quizzes that are active."
+    )
+    parser.add_argument("--requests", type=int, default=500, help="Requests per endpoint and driver.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent clients of the WSGI server.")
+    parser.add_argument(
+        "--drivers",
+        default="test_client,wsgi",
+        help="Comma-separated drivers: test_client, wsgi.",
+    )
+    parser.add_argument(
+        "--endpoints",
+        help="Comma-separated endpoints to run, all of them by default.",
+    )
+    parser.add_argument("--output", help="File to write the JSON report to, stdout by default.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(0)
+
+    quiz_app = load_app(args.mongo_url)
+
+    seed_started = time.perf_counter()
+    released_ids = seed(quiz_app, args.quizzes, args.active_fraction)
+    seed_seconds = time.perf_counter() - seed_started
+
+    client = quiz_app.app.test_client()
+    requests = scenarios(released_ids, collect_page_cursors(client))
+    if args.endpoints:
+        requests = {name: requests[name] for name in args.endpoints.split(",")}
+
+    drivers = args.drivers.split(",")
+    server = None
+    if "wsgi" in drivers:
+        # mongomock is not thread-safe -- the server then handles one request at a time
+        server = make_server(
+            "127.0.0.1",
+            0,
+            quiz_app.app,
+            threaded=bool(args.mongo_url),
+            request_handler=QuietRequestHandler,
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = []
+    try:
+        for endpoint, make_request in requests.items():
+            if "test_client" in drivers:
+                latencies, errors, elapsed = run_test_client(client, make_request, args.requests)
+                results.append(summarize(endpoint, "test_client", latencies, errors, elapsed))
+
+            if server is not None:
+                latencies, errors, elapsed = run_wsgi(
+                    server.server_address, make_request, args.requests, args.concurrency
+                )
+                results.append(summarize(endpoint, "wsgi", latencies, errors, elapsed))
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    report = {
+        "config": {
+            "mongo": "mongod" if args.mongo_url else "mongomock",
+            "quizzes": args.quizzes,
+            "active_fraction": args.active_fraction,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "seed_seconds": round(seed_seconds, 3),
+        },
+        "results": results,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            report_file.write(output + "\n")
+    else:
+        print(output)
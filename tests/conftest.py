@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The app connects lazily -- tests of the in-memory parts never wait for a MongoDb server
+os.environ.setdefault("MONGODB_CONNECTION_URL", "mongodb://localhost:1")
+os.environ.setdefault("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "100")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
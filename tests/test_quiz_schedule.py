@@ -0,0 +1,139 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+from bson.objectid import ObjectId
+
+from app import RESULT_RELEASE_DELAY, QuizSchedule
+
+BASE = datetime(2026, 1, 1, 12, 0)
+
+
+def make_quiz(start, end, created=None):
+    return {
+        "_id": ObjectId.from_datetime(created) if created else ObjectId(),
+        "question": "Q",
+        "options": ["a", "b"],
+        "start_date": start,
+        "end_date": end,
+    }
+
+
+def random_quizzes(rng, count):
+    quizzes = []
+    for _ in range(count):
+        start = BASE + timedelta(minutes=rng.randrange(0, 200))
+        quizzes.append(make_quiz(start, start + timedelta(minutes=rng.randrange(0, 60))))
+    return quizzes
+
+
+# Quizzes added in several batches, so the schedule holds more than one tree
+def loaded_schedule(quizzes, batch=7):
+    schedule = QuizSchedule()
+    for index in range(0, len(quizzes), batch):
+        schedule.add(quizzes[index : index + batch])
+    return schedule
+
+
+def test_active_at_matches_a_scan():
+    rng = random.Random(1)
+    quizzes = random_quizzes(rng, 120)
+    schedule = loaded_schedule(quizzes)
+    assert len(schedule.trees) > 1
+
+    moments = [BASE + timedelta(minutes=minute) for minute in range(-5, 270)]
+    moments += [quiz["start_date"] for quiz in quizzes] + [quiz["end_date"] for quiz in quizzes]
+    for at in moments:
+        expected = sorted(
+            quiz["_id"] for quiz in quizzes if quiz["start_date"] <= at <= quiz["end_date"]
+        )
+        assert [quiz["id"] for quiz in schedule.active_at(at)] == expected
+
+
+def test_active_at_includes_both_ends():
+    quiz = make_quiz(BASE, BASE + timedelta(minutes=10))
+    schedule = loaded_schedule([quiz])
+
+    assert schedule.active_at(BASE - timedelta(seconds=1)) == []
+    assert [summary["id"] for summary in schedule.active_at(BASE)] == [quiz["_id"]]
+    assert [summary["id"] for summary in schedule.active_at(quiz["end_date"])] == [quiz["_id"]]
+    assert schedule.active_at(quiz["end_date"] + timedelta(seconds=1)) == []
+
+
+def test_add_skips_known_quizzes():
+    quiz = make_quiz(BASE, BASE + timedelta(minutes=10))
+    schedule = loaded_schedule([quiz])
+    schedule.add([quiz])
+
+    assert len(schedule.active_at(BASE)) == 1
+
+
+def test_next_boundary_matches_a_scan():
+    rng = random.Random(2)
+    quizzes = random_quizzes(rng, 80)
+    schedule = loaded_schedule(quizzes)
+
+    for minute in range(-5, 270):
+        at = BASE + timedelta(minutes=minute)
+        upcoming = [quiz["start_date"] for quiz in quizzes if quiz["start_date"] > at]
+        upcoming += [quiz["end_date"] for quiz in quizzes if quiz["end_date"] >= at]
+        assert schedule.next_boundary(at) == min(upcoming, default=None)
+
+
+def test_next_boundary_of_an_empty_schedule():
+    assert QuizSchedule().next_boundary(BASE) is None
+
+
+def test_events_between_matches_a_scan():
+    rng = random.Random(3)
+    quizzes = random_quizzes(rng, 60)
+    schedule = loaded_schedule(quizzes)
+
+    all_events = []
+    for quiz in quizzes:
+        all_events += [
+            (quiz["start_date"], "quiz_started", quiz["_id"]),
+            (quiz["end_date"], "quiz_ended", quiz["_id"]),
+            (quiz["end_date"] + RESULT_RELEASE_DELAY, "result_released", quiz["_id"]),
+        ]
+
+    for minute in range(-5, 270, 7):
+        after = BASE + timedelta(minutes=minute)
+        until = after + timedelta(minutes=rng.randrange(0, 30))
+        events = schedule.events_between(after, until)
+
+        assert [moment for moment, _, _ in events] == sorted(moment for moment, _, _ in events)
+        assert sorted((moment, name, quiz["id"]) for moment, name, quiz in events) == sorted(
+            event for event in all_events if after < event[0] <= until
+        )
+
+
+def test_events_between_sends_the_missed_events_of_late_added_quizzes():
+    schedule = QuizSchedule()
+    schedule.track_added()
+
+    since = BASE
+    created = (BASE + timedelta(minutes=1)).astimezone(timezone.utc)
+    # Created on another worker and loaded only after its start was behind the stream
+    quiz = make_quiz(BASE + timedelta(minutes=2), BASE + timedelta(minutes=20), created)
+    schedule.add([quiz], version=1)
+
+    after = BASE + timedelta(minutes=5)
+    events = schedule.events_between(after, after + timedelta(minutes=1), since)
+    assert [(moment, name) for moment, name, _ in events] == [(quiz["start_date"], "quiz_started")]
+
+    # Sent once -- the next call only has the events of its own window
+    assert schedule.events_between(after, after + timedelta(minutes=1), since) == []
+
+
+def test_events_between_skips_events_before_since():
+    schedule = QuizSchedule()
+    schedule.track_added()
+
+    since = BASE + timedelta(minutes=3)
+    created = BASE.astimezone(timezone.utc)
+    quiz = make_quiz(BASE + timedelta(minutes=2), BASE + timedelta(minutes=4), created)
+    schedule.add([quiz], version=1)
+
+    after = BASE + timedelta(minutes=5)
+    events = schedule.events_between(after, after, since)
+    assert [(moment, name) for moment, name, _ in events] == [(quiz["end_date"], "quiz_ended")]